@@ -0,0 +1,656 @@
+""" Benchmarks of the build, cleanup and serve paths on reproducible synthetic trees.
+Every case runs in its own process, so the peak RSS and the read/write counters belong to the case only.
+The cases and the checks use a home directory in the work directory, the cache of the user isn't touched.
+Results can be saved as a baseline and compared with it, the comparison fails on regressions.
+
+Usage: python -m swfv.bench [--scale F] [--trees wide,deep,...] [--save FILE] [--compare FILE]
+       python -m swfv.bench --import-time [--import-budget MS]
+       python -m swfv.bench --check-render
+       python -m swfv.bench --check-builds
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import closing, contextmanager, redirect_stdout
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+from unittest import mock
+from urllib.parse import quote
+
+from swfv.builder import PageBuilder
+from swfv.config import Config
+from swfv.core import CHANGES_REMOVED_PREFIX, process_dir, scan_meta
+from swfv.extra import cleanup
+from swfv.server import (
+    DynamicRequestHandler,
+    FileRequestHandler,
+    HashIndex,
+    ListingCache,
+    PooledHTTPServer,
+    _bind_directory,
+)
+from swfv.utils.common import HashUtil
+from swfv.utils.fs import FileUtil
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+
+logger = logging.getLogger()
+
+TREE_VERSION = 1
+TREE_MARKER = ".bench-tree.json"
+# fixed modification time of the generated files, page hashes and manifests don't depend on the generation time
+TREE_MTIME = 1_700_000_000
+CASES = ("build", "rebuild", "serve", "serve-dynamic", "cleanup")
+# metric -> True if the larger value is better
+METRICS = {
+    "seconds": False,
+    "files_per_sec": True,
+    "bytes_hashed_per_sec": True,
+    "pages_per_sec": True,
+    "requests_per_sec": True,
+    "read_write_calls": False,
+    "peak_rss_kb": False,
+}
+DEF_THRESHOLD = 0.2
+# timings of the shorter cases are noise, only their read/write calls and memory are compared
+MIN_SECONDS = 0.05
+TIMING_METRICS = ("seconds", "files_per_sec", "bytes_hashed_per_sec", "pages_per_sec", "requests_per_sec")
+SERVE_REQUESTS = 1000
+MIXED_TYPES = ("jpg", "png", "mp4", "mp3", "pdf", "txt", "md", "py", "json", "zip", "html", "csv")
+# import time checks: name -> (code, modules which the code must not import), the budget is for the first check
+IMPORT_CHECKS = {
+    "swfv --version": ("import swfv; swfv.main(['--version'])",
+                       ("jinja2", "multiprocessing", "http.server", "sqlite3", "swfv.core", "swfv.server")),
+    "swfv.core": ("import swfv.core", ("jinja2", "multiprocessing", "http.server")),
+    "swfv.server": ("import swfv.server", ("jinja2", "multiprocessing", "sqlite3", "swfv.builder", "swfv.core",
+                                           "swfv.index", "swfv.search", "swfv.thumbs")),
+}
+DEF_IMPORT_BUDGET_MS = 100.0
+# names which need escaping in the pages, for the comparison of the renderers
+RENDER_CHECK_NAMES = ("a&b.txt", "<b>bold.html", "it's \"quoted\".md", "space name.jpg", "файл.png", "README")
+# config options of the renderer comparisons
+RENDER_CHECK_VARIANTS = (
+    {},
+    {"flags": ["hide-generated-by", "hide-title"], "search_index": True, "page_size": 7, "name": "A&B <site>"},
+)
+
+
+@dataclass
+class TreeSpec:
+    """ Shape of a synthetic tree, the counts are multiplied by the scale """
+    name: str
+    description: str
+    generate: Callable[[TreeWriter, float], None]
+
+
+class TreeWriter:
+    """ Writes files of a tree with the content from the seeded random generator """
+    def __init__(self, root: Path, seed: str) -> None:
+        self.root = root
+        self.random = random.Random(seed)
+        self.block = self.random.randbytes(1024 * 1024)
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+
+    def dir(self, rel_path: str) -> str:
+        path = self.root / rel_path
+        if not path.exists():
+            path.mkdir(parents=True)
+            self.dirs += 1
+        return rel_path
+
+    def file(self, rel_path: str, size: int | None = None, content: bytes | None = None) -> None:
+        path = self.root / rel_path
+        with path.open("wb") as writer:
+            if content is None:
+                size = size or 0
+                offset = self.random.randrange(len(self.block))
+                left = size
+                while left > 0:
+                    chunk = self.block[offset:offset + left]
+                    writer.write(chunk)
+                    left -= len(chunk)
+                    offset = 0
+                content_size = size
+            else:
+                writer.write(content)
+                content_size = len(content)
+        os.utime(path, (TREE_MTIME, TREE_MTIME))
+        self.files += 1
+        self.bytes += content_size
+
+    def size(self, low: int, high: int) -> int:
+        return self.random.randint(low, high)
+
+
+def _scaled(value: int, scale: float) -> int:
+    return max(1, int(value * scale))
+
+
+def _gen_wide(w: TreeWriter, scale: float) -> None:
+    # one directory with more entries than a page
+    w.dir("wide")
+    for i in range(_scaled(12_000, scale)):
+        w.file(f"wide/file-{i:06d}.txt", w.size(0, 256))
+
+
+def _gen_deep(w: TreeWriter, scale: float) -> None:
+    path = ""
+    for level in range(_scaled(64, scale)):
+        path = w.dir(f"{path}/level-{level:03d}".lstrip("/"))
+        for i in range(8):
+            w.file(f"{path}/file-{i}.txt", w.size(0, 1024))
+
+
+def _gen_tiny(w: TreeWriter, scale: float) -> None:
+    for d in range(_scaled(100, scale)):
+        w.dir(f"dir-{d:03d}")
+        for i in range(200):
+            w.file(f"dir-{d:03d}/tiny-{i:03d}.txt", w.size(0, 64))
+
+
+def _gen_huge(w: TreeWriter, scale: float) -> None:
+    for i in range(4):
+        w.file(f"huge-{i}.bin", _scaled(32 * 1024 * 1024, scale))
+    w.file("readme.txt", 100)
+
+
+def _gen_mixed(w: TreeWriter, scale: float) -> None:
+    for d in range(_scaled(40, scale)):
+        ext_list = ("jpg", "png") if d % 4 == 0 else MIXED_TYPES
+        w.dir(f"mixed-{d:02d}/sub")
+        for i in range(100):
+            ext = ext_list[w.random.randrange(len(ext_list))]
+            parent = f"mixed-{d:02d}" if i % 5 else f"mixed-{d:02d}/sub"
+            w.file(f"{parent}/file {i:03d}.{ext}", w.size(1024, 256 * 1024))
+
+
+def _gen_links(w: TreeWriter, scale: float) -> None:
+    for d in range(_scaled(20, scale)):
+        w.dir(f"links-{d:02d}")
+        for i in range(100):
+            content = f"[InternetShortcut]\nURL=https://example.com/{d}/{i}\n".encode()
+            w.file(f"links-{d:02d}/link-{i:03d}.url", content=content)
+        w.file(f"links-{d:02d}/notes.txt", w.size(100, 1000))
+
+
+TREES = {spec.name: spec for spec in (
+    TreeSpec("wide", "one directory with many small files, it has several pages", _gen_wide),
+    TreeSpec("deep", "a chain of nested directories with a few files on every level", _gen_deep),
+    TreeSpec("tiny", "many directories with many tiny files", _gen_tiny),
+    TreeSpec("huge", "a few huge files, hashing dominates", _gen_huge),
+    TreeSpec("mixed", "files of the different types, some directories have images only", _gen_mixed),
+    TreeSpec("links", "directories with .url links", _gen_links),
+)}
+
+
+def generate_tree(name: str, root: Path, scale: float) -> dict:
+    """ Create the tree if it doesn't exist or was created with other parameters, returns its stats """
+    marker = root / TREE_MARKER
+    params = {"version": TREE_VERSION, "name": name, "scale": scale}
+    if marker.exists():
+        stats = json.loads(marker.read_text())
+        if stats.get("params") == params:
+            return stats
+    if root.exists():
+        shutil.rmtree(root)
+    root.mkdir(parents=True)
+    print(f"Generate tree '{name}' (scale={scale}) in {root}...", file=sys.stderr)
+    writer = TreeWriter(root, seed=f"{name}:{scale}")
+    TREES[name].generate(writer, scale)
+    stats = {"params": params, "files": writer.files, "dirs": writer.dirs, "bytes": writer.bytes}
+    marker.write_text(json.dumps(stats))
+    return stats
+
+
+def _io_counters() -> tuple[int, int] | None:
+    """ Number of the read and write calls of the current process from /proc/self/io (Linux only) """
+    try:
+        with open("/proc/self/io") as reader:
+            values = dict(line.split(":", 1) for line in reader if ":" in line)
+        return int(values["syscr"]), int(values["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss_kb() -> int | None:
+    try:
+        import resource  # not available on Windows
+    except ImportError:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes on Linux
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _count_pages(output: Path, config: Config) -> int:
+    return sum(1 for _, _, files in os.walk(output) for name in files
+               if name == config.index_file or config.get_page_number(name) is not None)
+
+
+def _create_config(source: Path, output: Path, jobs: int, incremental: bool = False) -> Config:
+    return Config(source=source, output=output, quiet=True, force=True, incremental=incremental,
+                  jobs=jobs, thumbnails=False)
+
+
+def _fetch_all(host: str, port: int, urls: list[str]) -> int:
+    """ Request the urls with one keep-alive connection until SERVE_REQUESTS are done """
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    count = 0
+    try:
+        while count < SERVE_REQUESTS:
+            for url in urls:
+                connection.request("GET", url)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"GET {url}: {response.status}")
+                count += 1
+    finally:
+        connection.close()
+    return count
+
+
+def _get_urls(root: Path, config: Config, max_files: int = 200) -> list[str]:
+    urls = []
+    files = []
+    for work_dir, dirs, names in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != config.assets_dir)
+        rel_path = Path(work_dir).relative_to(root).as_posix()
+        prefix = "/" if rel_path == "." else f"/{quote(rel_path)}/"
+        urls.append(prefix)
+        files.extend(prefix + quote(name) for name in sorted(names)
+                     if not name.startswith(".") and name != config.index_file and config.get_page_number(name) is None)
+    return urls + files[:max_files]
+
+
+@contextmanager
+def _start_server(handler: type, directory: Path) -> Generator[int, None, None]:
+    """ Run the HTTP server in a thread, yields its port """
+    with PooledHTTPServer(("127.0.0.1", 0), _bind_directory(handler, directory.absolute())) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield httpd.server_address[1]
+        finally:
+            httpd.shutdown()
+
+
+def _measure(func: Callable[[], int | None]) -> tuple[float, int | None, int | None]:
+    """ Run the function, returns the seconds, the read/write calls and the result of the function """
+    io_before = _io_counters()
+    started = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - started
+    io_after = _io_counters()
+    return seconds, sum(io_after) - sum(io_before) if io_before and io_after else None, value
+
+
+def _cleanup(output: Path, config: Config) -> None:
+    with mock.patch("builtins.input", return_value="y"), redirect_stdout(io.StringIO()):
+        if cleanup(output, config=config):
+            raise RuntimeError(f"Cleanup failed in {output}")
+
+
+def run_case(tree: str, case: str, work: Path, jobs: int) -> dict:
+    """ Run one case of the tree in the current process, returns its metrics """
+    source = work / "trees" / tree
+    output = work / "out" / tree
+    stats = json.loads((source / TREE_MARKER).read_text())
+    config = _create_config(source, output, jobs, incremental=case == "rebuild")
+    if case == "build":
+        # cold build: no generated files and no cached hashes
+        shutil.rmtree(output, ignore_errors=True)
+        shutil.rmtree(Path.home() / ".cache" / Config.APP_NAME, ignore_errors=True)
+    elif not (output / config.index_file).exists():
+        raise RuntimeError(f"Case '{case}' needs the output of the 'build' case: {output}")
+
+    requests = 0
+    if case in ("build", "rebuild"):
+        seconds, io_calls, _ = _measure(lambda: process_dir(source, config=config))
+    elif case == "serve":
+        urls = _get_urls(output, config)
+        handler = type("Handler", (FileRequestHandler,), {"hash_index": HashIndex(meta_file=config.meta_file),
+                                                          "index_file": config.index_file})
+        with _start_server(handler, output) as port:
+            seconds, io_calls, requests = _measure(lambda: _fetch_all("127.0.0.1", port, urls))
+    elif case == "serve-dynamic":
+        urls = _get_urls(source, config)
+        cache = ListingCache(config, PageBuilder(config=config))
+        handler = type("Handler", (DynamicRequestHandler,), {"hash_index": HashIndex(), "listing_cache": cache,
+                                                              "index_file": config.index_file})
+        try:
+            with _start_server(handler, source) as port:
+                seconds, io_calls, requests = _measure(lambda: _fetch_all("127.0.0.1", port, urls))
+        finally:
+            cache.close()
+    elif case == "cleanup":
+        seconds, io_calls, _ = _measure(lambda: _cleanup(output, config))
+    else:
+        raise ValueError(f"Unknown case '{case}', available: {CASES}")
+
+    result: dict = {"seconds": round(seconds, 4)}
+    if case in ("build", "rebuild"):
+        result["files_per_sec"] = round(stats["files"] / seconds, 1)
+    if case == "build":
+        result["bytes_hashed_per_sec"] = round(stats["bytes"] / seconds)
+        result["pages_per_sec"] = round(_count_pages(output, config) / seconds, 1)
+    if requests:
+        result["requests_per_sec"] = round(requests / seconds, 1)
+    if io_calls is not None:
+        result["read_write_calls"] = io_calls
+    rss = _peak_rss_kb()
+    if rss is not None:
+        result["peak_rss_kb"] = rss
+    return result
+
+
+def measure_import_time(code: str, repeat: int = 5) -> tuple[float, set[str]]:
+    """ Run the code with python -X importtime, returns the import time of the swfv modules and the modules
+    imported after them (ms, the best of the runs) and all imported modules
+    """
+    best = math.inf
+    modules: set[str] = set()
+    for _ in range(repeat):
+        cmd = [sys.executable, "-X", "importtime", "-c", code]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        total, started = 0, False
+        for line in proc.stderr.splitlines():
+            parts = line.removeprefix("import time:").split("|")
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name = parts[2].removeprefix(" ").rstrip()
+            modules.add(name.strip())
+            # the top level imports, startup modules (site, encodings) are imported before swfv
+            started = started or name.startswith("swfv")
+            if started and not name.startswith(" "):
+                total += int(parts[1])
+        best = min(best, total / 1000)
+    return best, modules
+
+
+def check_import_time(budget_ms: float) -> list[str]:
+    """ Returns the errors: slow modules imported by the short commands and the import time over the budget """
+    errors = []
+    for i, (name, (code, slow_modules)) in enumerate(IMPORT_CHECKS.items()):
+        ms, modules = measure_import_time(code)
+        print(f"{name:<20} import_ms={ms:.1f}", file=sys.stderr)
+        errors.extend(f"{name} imports {m}" for m in slow_modules if m in modules)
+        if i == 0 and ms > budget_ms:
+            errors.append(f"{name} import time {ms:.1f}ms is over the budget {budget_ms:.1f}ms")
+    return errors
+
+
+def check_render(work: Path) -> list[str]:
+    """ Render the directories of the small trees by the built-in renderer of the default theme and by page.j2
+    with Jinja, returns the differences
+    """
+    root = work / "render"
+    for name in ("mixed", "links"):
+        generate_tree(name, root / name, scale=0.05)
+    writer = TreeWriter(root / "names", seed="names")
+    for i, name in enumerate(RENDER_CHECK_NAMES):
+        writer.dir(f"{RENDER_CHECK_NAMES[i - 1]} & dir")
+        writer.file(name, i * 1000)
+        writer.file(f"{RENDER_CHECK_NAMES[i - 1]} & dir/{name}", i)
+    errors = []
+    for options in RENDER_CHECK_VARIANTS:
+        config = Config(source=root, output=work / "render-output", quiet=True, hash_mode="none", **options)
+        builder = PageBuilder(config=config)
+        renderer = builder.renderer
+        if renderer is None:
+            return [f"{builder.theme_path} isn't rendered by DefaultPageRenderer, update it and its TEMPLATE_HASH"]
+        hash_util = HashUtil(config.APP_NAME)
+        try:
+            for work_dir, _, _ in FileUtil.walk(root):
+                meta = scan_meta(work_dir, config, hash_util, depth=len(work_dir.relative_to(root).parts))
+                meta.has_thumbnails = len(meta.files) % 2 == 0
+                for page in range(1, builder.get_page_count(meta) + 1):
+                    builder.renderer = renderer
+                    expected = builder.render_page(meta, page=page)
+                    builder.renderer = None
+                    actual = builder.render_page(meta, page=page)
+                    if expected != actual:
+                        line = next(i for i, (a, b) in enumerate(zip(expected.split("\n"), actual.split("\n"), strict=False))
+                                    if a != b) if expected.count("\n") == actual.count("\n") else -1
+                        errors.append(f"{work_dir} page {page} {options}: the output is different (line {line + 1})")
+        finally:
+            hash_util.close()
+    return errors
+
+
+def _read_tree_index(path: Path) -> list[tuple]:
+    """ Sorted records of the tree index file """
+    if path.suffix == Config.TREE_INDEX_FORMATS["sqlite"]:
+        import sqlite3  # optional index format
+        with closing(sqlite3.connect(path)) as db:
+            return sorted(db.execute("SELECT * FROM entries"))
+    with path.open("rt", encoding="utf-8") as reader:
+        return sorted(tuple(json.loads(line).values()) for line in reader)
+
+
+def check_builds(work: Path) -> list[str]:
+    """ Build a small tree with the incremental options, returns the differences from the full builds """
+    root = work / "builds"
+    source = root / "source"
+    shutil.rmtree(root, ignore_errors=True)
+    generate_tree("mixed", source, scale=0.05)
+    errors = []
+    for tree_index in Config.TREE_INDEX_FORMATS:
+        outputs = {mode: root / f"{tree_index}-{mode}" for mode in ("incremental", "full")}
+        for step in ("first build", "changed file"):
+            if step == "changed file":
+                (source / "added.txt").write_text(step)
+            for mode, output in outputs.items():
+                config = Config(source=source, output=output, quiet=True, force=True, incremental=mode == "incremental",
+                                tree_index=tree_index, hash_mode="none", thumbnails=False)
+                process_dir(source, config)
+            index_files = [output / config.tree_index_file for output in outputs.values()]
+            if not index_files[0].exists():
+                errors.append(f"--tree-index {tree_index} -I, {step}: {index_files[0]} doesn't exist")
+            elif _read_tree_index(index_files[0]) != _read_tree_index(index_files[1]):
+                errors.append(f"--tree-index {tree_index} -I, {step}: the index is different from the full build")
+        (source / "added.txt").unlink()
+    errors.extend(_check_removed_pages(root / "pages"))
+    errors.extend(_check_user_pages(root / "user-pages"))
+    return errors
+
+
+def _check_user_pages(root: Path) -> list[str]:
+    """ Pages of the users (index-2.html without the marker) are listed and kept by the in-place builds """
+    writer = TreeWriter(root, seed="user-pages")
+    root.mkdir(parents=True)
+    writer.file("file.txt", 10)
+    writer.file("index-2.html", content=b"<html>user page</html>\n")
+    config = Config(source=root, output=root, quiet=True, force=True, hash_mode="none", thumbnails=False)
+    process_dir(root, config)
+    errors = []
+    if not (root / "index-2.html").exists():
+        errors.append("in-place build removed the page of the user: index-2.html")
+    elif f"{CHANGES_REMOVED_PREFIX}index-2.html" in (root / config.changes_file).read_text().splitlines():
+        errors.append(f"page of the user is listed as removed in {config.changes_file}")
+    names = [item["name"] for item in json.loads((root / config.meta_file).read_text()).get("files", [])]
+    if "index-2.html" not in names:
+        errors.append(f"page of the user isn't listed in {config.meta_file}")
+    return errors
+
+
+def _check_removed_pages(root: Path) -> list[str]:
+    """ A paginated directory shrinks, its pages which are left from the previous build are removed
+    and listed in the changes file
+    """
+    source = root / "source"
+    errors = []
+    for jobs in (1, 2):
+        writer = TreeWriter(source, seed="pages")
+        writer.dir("pages")
+        for i in range(12):
+            writer.file(f"pages/file-{i:02}.txt", 10)
+        config = Config(source=source, output=root / f"output-{jobs}", quiet=True, force=True, incremental=True,
+                        page_size=4, gzip_level=1, jobs=jobs, hash_mode="none", thumbnails=False)
+        process_dir(source, config)
+        for i in range(4, 12):
+            (source / f"pages/file-{i:02}.txt").unlink()
+        process_dir(source, config)
+        changes = (config.output / config.changes_file).read_text().splitlines()
+        expected = [f"{CHANGES_REMOVED_PREFIX}pages/{config.get_page_file(page)}{ext}"
+                    for page in (2, 3) for ext in ("", ".gz")]
+        missing = [line for line in expected if line not in changes]
+        if missing:
+            errors.append(f"-j {jobs}, removed pages aren't listed in {config.changes_file}: {missing}")
+        if any((config.output / "pages" / config.get_page_file(page)).exists() for page in (2, 3)):
+            errors.append(f"-j {jobs}, pages of the previous build aren't removed")
+    return errors
+
+
+def run_suite(trees: list[str], work: Path, scale: float, jobs: int, repeat: int) -> dict:
+    """ Run all cases for the trees, every case in a new process. The best result of the repeats is kept. """
+    results: dict[str, dict] = {}
+    env = dict(os.environ, HOME=str((work / "home").absolute()))
+    for tree in trees:
+        generate_tree(tree, work / "trees" / tree, scale)
+        for _ in range(repeat):
+            for case in CASES:
+                cmd = [sys.executable, "-m", "swfv.bench", "--work", str(work), "--jobs", str(jobs),
+                       "--run-case", tree, case]
+                proc = subprocess.run(cmd, env=env, capture_output=True, text=True, check=False)
+                if proc.returncode:
+                    raise RuntimeError(f"Case {tree}/{case} failed: {proc.stderr.strip()[-2000:]}")
+                current = json.loads(proc.stdout.strip().splitlines()[-1])
+                key = f"{tree}/{case}"
+                results[key] = _best(results[key], current) if key in results else current
+                print(f"{key:<20} {_format(results[key])}", file=sys.stderr)
+    return {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "scale": scale, "jobs": jobs,
+                 "version": Config.APP_VERSION},
+        "results": results,
+    }
+
+
+def _best(first: dict, second: dict) -> dict:
+    return {k: (max if METRICS.get(k) else min)(v, second[k]) if k in second else v for k, v in first.items()}
+
+
+def _format(metrics: dict) -> str:
+    return "  ".join(f"{k}={v}" for k, v in metrics.items())
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """ Returns the regressions: metrics which are worse than in the baseline by more than the threshold """
+    regressions = []
+    for key, metrics in current["results"].items():
+        base_metrics = baseline.get("results", {}).get(key)
+        if not base_metrics:
+            continue
+        skip_timings = base_metrics.get("seconds", 0) < MIN_SECONDS
+        for metric, value in metrics.items():
+            base = base_metrics.get(metric)
+            if not base or metric not in METRICS or (skip_timings and metric in TIMING_METRICS):
+                continue
+            change = (value - base) / base
+            if (METRICS[metric] and change < -threshold) or (not METRICS[metric] and change > threshold):
+                regressions.append(f"{key} {metric}: {base} -> {value} ({change:+.1%})")
+    return regressions
+
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="swfv.bench", description=__doc__.split("\n")[0].strip())
+    parser.add_argument("--work", type=Path, default=Path(os.getenv("TMPDIR", "/tmp")) / "swfv-bench",
+                        help="Directory for the generated trees and outputs (default: %(default)s)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier of the tree sizes (default: 1.0)")
+    parser.add_argument("--trees", default=",".join(TREES),
+                        help=f"Comma separated trees to run: {','.join(TREES)} (default: all)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of the build jobs (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1, help="Run the cases N times and keep the best results")
+    parser.add_argument("--save", type=Path, metavar="FILE", help="Save the results as a baseline")
+    parser.add_argument("--compare", type=Path, metavar="FILE", help="Compare the results with the baseline")
+    parser.add_argument("--threshold", type=float, default=DEF_THRESHOLD,
+                        help=f"Allowed regression of the metrics, 0.2 is 20%% (default: {DEF_THRESHOLD})")
+    parser.add_argument("--import-time", action="store_true",
+                        help="Check the import time of the short commands instead of the benchmarks")
+    parser.add_argument("--import-budget", type=float, default=DEF_IMPORT_BUDGET_MS, metavar="MS",
+                        help=f"Import time budget of 'swfv --version' (default: {DEF_IMPORT_BUDGET_MS})")
+    parser.add_argument("--check-render", action="store_true",
+                        help="Check that the built-in renderer of the default theme writes the same pages as Jinja")
+    parser.add_argument("--check-builds", action="store_true",
+                        help="Check that the incremental builds write the same files as the full builds "
+                        "and list the removed pages in the changes file, the pages of the users are kept")
+    parser.add_argument("--run-case", nargs=2, metavar=("TREE", "CASE"), help=argparse.SUPPRESS)
+    pargs = parser.parse_args(args)
+    work = pargs.work.absolute()
+    # the cold builds remove the hash cache, the cases and the checks must not use the cache of the user
+    os.environ["HOME"] = str(work / "home")
+
+    if pargs.run_case:
+        logging.basicConfig(format="%(message)s", level=logging.WARNING)
+        print(json.dumps(run_case(pargs.run_case[0], pargs.run_case[1], work, pargs.jobs)))
+        return 0
+
+    if pargs.import_time:
+        errors = check_import_time(pargs.import_budget)
+        for line in errors:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if errors else 0
+
+    if pargs.check_render:
+        logging.basicConfig(format="%(message)s", level=logging.WARNING)
+        errors = check_render(work)
+        for line in errors:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if not errors:
+            print("The built-in renderer writes the same pages as page.j2", file=sys.stderr)
+        return 1 if errors else 0
+
+    if pargs.check_builds:
+        logging.basicConfig(format="%(message)s", level=logging.WARNING)
+        errors = check_builds(work)
+        for line in errors:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if not errors:
+            print("The incremental builds write the same files as the full builds", file=sys.stderr)
+        return 1 if errors else 0
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    trees = [v.strip() for v in pargs.trees.split(",") if v.strip()]
+    unknown = [v for v in trees if v not in TREES]
+    if unknown:
+        parser.error(f"Unknown trees: {unknown}, available: {list(TREES)}")
+    report = run_suite(trees, work, scale=pargs.scale, jobs=pargs.jobs, repeat=max(1, pargs.repeat))
+    print(json.dumps(report, indent=2))
+    if pargs.save:
+        pargs.save.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Baseline saved: {pargs.save}", file=sys.stderr)
+    if pargs.compare:
+        if not pargs.compare.exists():
+            print(f"Baseline {pargs.compare} doesn't exist, nothing to compare", file=sys.stderr)
+            return 0
+        baseline = json.loads(pargs.compare.read_text())
+        if baseline.get("meta", {}).get("scale") != pargs.scale:
+            print(f"Baseline scale {baseline.get('meta', {}).get('scale')} != {pargs.scale}", file=sys.stderr)
+        regressions = compare(baseline, report, pargs.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {pargs.compare} (threshold {pargs.threshold:.0%})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,61 @@
 """
 """
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import json
 import logging
+import math
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-import jinja2
-
 from swfv.config import Config
 from swfv.data import FileType
+from swfv.render import DefaultPageRenderer
+from swfv.thumbs import has_thumbnail
 from swfv.utils.common import HashUtil
 from swfv.utils.fs import FileUtil
+from swfv.utils.stats import STATS
 
 if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+    from concurrent.futures import ProcessPoolExecutor
+
+    import jinja2
+
     from swfv.data import FileInfo, Meta
 
 logger = logging.getLogger()
 
-STARTED = datetime.now(tz=timezone.utc)
-STARTED_ISO = STARTED.isoformat()[:19]
-STARTED_ID = STARTED.strftime("%y%m%d%H%M%S")
+_started: datetime | None = None
+_worker_builder: PageBuilder | None = None
+
+
+def get_started() -> datetime:
+    """ Generation time of the pages, it is set on the first use and is the same for all pages of the build """
+    global _started
+    if _started is None:
+        _started = datetime.now(tz=timezone.utc)
+    return _started
+
+
+def _init_worker(config: Config, started: datetime, log_level: int, theme_hash: str) -> None:
+    global _worker_builder, _started
+    logging.basicConfig(format="%(message)s", level=log_level)
+    # all pages must have the same generation time as in the main process
+    _started = started
+    FileUtil.register_file_types(config.file_types)
+    STATS.enabled = config.stats
+    # the theme is hashed once in the main process, not by every worker
+    _worker_builder = PageBuilder(config=config, theme_hash=theme_hash)
+
+
+def get_worker_builder() -> PageBuilder:
+    """ PageBuilder of the current worker process of the pool created by PageBuilder.create_pool """
+    if _worker_builder is None:
+        raise RuntimeError("PageBuilder worker was not initialized")
+    return _worker_builder
 
 
 @dataclass
@@ -35,10 +69,11 @@ class PageItem:
     is_file: bool = False
     created: str = ""
     modified: str = ""
+    thumbnail: str = ""
     origin: FileInfo | None = None
 
     @staticmethod
-    def from_file_info(file_info: FileInfo, meta: Meta) -> PageItem:
+    def from_file_info(file_info: FileInfo, meta: Meta, asset_url: Callable[[str], str] | None = None) -> PageItem:
         if file_info.type != FileType.LINK:
             path = f"./{file_info.name}"
         else:
@@ -48,18 +83,30 @@ class PageItem:
             name=file_info.name,
             path=path,
             path_orig=file_info.name,
-            icon=f"{'../' * meta.depth}assets/icons/{file_info.thumbnail_sm}",
+            icon=f"{'../' * meta.depth}{(asset_url or PageItem.asset_path)(f'icons/{file_info.thumbnail_sm}')}",
             size=FileUtil.size_format(file_info.size),
             type=file_info.type.value.lower(),
             created=file_info.created.isoformat(sep=" ")[:19],
             modified=file_info.modified.isoformat(sep=" ")[:19],
         )
         item.is_file = item.type in FileType.values() and item.type != FileType.DIRECTORY.value
+        if meta.has_thumbnails and has_thumbnail(file_info):
+            item.thumbnail = f"./{meta.thumbnail_dir}/{file_info.thumbnail_md}"
         return item
 
+    @staticmethod
+    def asset_path(name: str) -> str:
+        return f"{Config.DEF_ASSETS_DIR}/{name}"
+
 
 class PageBuilder:
-    def __init__(self, config: Config) -> None:
+    # theme assets which are worth to compress, images are compressed already
+    GZIP_SUFFIXES = (".css", ".js", ".json", ".svg", ".ico", ".webmanifest", ".html", ".txt")
+    # names of the theme assets with the content hashes (css/site.3f2a9c1d.css), see get_assets
+    ASSET_MANIFEST = "asset-manifest.json"
+    FINGERPRINT_LENGTH = Config.ASSETS_FINGERPRINT_LENGTH
+
+    def __init__(self, config: Config, theme_hash: str | None = None) -> None:
         self.config = config
         self.theme_path = Path(config.theme)
         if not self.theme_path.exists():
@@ -68,64 +115,239 @@ class PageBuilder:
         if not self.theme_path.exists():
             raise OSError(f"Theme not found: {self.theme_path}")
         self.hash_util = HashUtil(self.config.APP_NAME)
-        self.engine = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self.theme_path.absolute()),
-            autoescape=True)
+        self._theme_hash = theme_hash
+        # Jinja is imported and the environment is created on the first render,
+        # incremental builds without changes and other commands don't need it
+        self._engine: jinja2.Environment | None = None
+        self._page_tmpl: jinja2.Template | None = None
+        self._assets: dict[str, dict] | None = None
+        self._asset_sources: dict[str, str] | None = None
+        # the default theme is rendered without Jinja, other themes and changed templates need it
+        self.renderer: DefaultPageRenderer | None = None
+        if DefaultPageRenderer.supports(self.theme_path):
+            self.renderer = DefaultPageRenderer(config, asset_url=self.asset_url)
+        else:
+            logger.debug("Render pages with Jinja: %s", self.theme_path)
+
+    @property
+    def theme_hash(self) -> str:
+        """ Hash of the theme files without the assets, it is calculated on the first use """
+        if self._theme_hash is None:
+            values = []
+            for p in sorted(self.theme_path.rglob("*")):
+                if p.is_file() and self.config.assets_dir not in p.relative_to(self.theme_path).parts:
+                    values.extend((str(p.relative_to(self.theme_path)).encode("utf-8"), p.read_bytes()))
+            self._theme_hash = self.hash_util.get_hash(b"\0".join(values))
+        return self._theme_hash
+
+    @property
+    def assets(self) -> dict[str, dict]:
+        """ Theme assets: relative path -> {"path": fingerprinted relative path, "hash": content hash, "size": size} """
+        if self._assets is None:
+            self._assets = {}
+            src = self.theme_path / self.config.assets_dir
+            for src_dir, _, files in FileUtil.walk(src, hidden=True):
+                for p, st in files:
+                    rel_path = p.relative_to(src).as_posix()
+                    content_hash = self.hash_util.get_hash(p.read_bytes())
+                    stem, dot, ext = rel_path.rpartition(".")
+                    fingerprint = content_hash[:PageBuilder.FINGERPRINT_LENGTH]
+                    path = f"{stem}.{fingerprint}.{ext}" if dot and "/" not in ext else f"{rel_path}.{fingerprint}"
+                    self._assets[rel_path] = {"path": path, "hash": content_hash, "size": st.st_size}
+        return self._assets
+
+    @property
+    def assets_hash(self) -> str:
+        """ Hash of all theme assets, the pages have to be rendered again if it is changed """
+        return self.hash_util.get_hash("|".join(f"{k}={v['hash']}" for k, v in sorted(self.assets.items())))
 
-    def create_index_file(self, meta: Meta, output_file: Path, force: bool = False) -> None:
-        output_file.parent.mkdir(parents=True, exist_ok=True)
+    def asset_url(self, name: str) -> str:
+        """ URL of the theme asset relative to the root of the site, with the fingerprinted name if it exists """
+        asset = self.assets.get(name)
+        return f"{self.config.assets_dir}/{asset['path'] if asset else name}"
+
+    def get_asset_source(self, path: str) -> str | None:
+        """ Relative path of the theme asset by its fingerprinted path, it is used by the dynamic server """
+        if self._asset_sources is None:
+            self._asset_sources = {v["path"]: k for k, v in self.assets.items()}
+        return self._asset_sources.get(path)
+
+    @property
+    def engine(self) -> jinja2.Environment:
+        if self._engine is None:
+            import jinja2  # slow import, see __init__
+            # compiled templates are stored in the cache, the directory is unique for the theme and Jinja version
+            cache_dir = self.hash_util.cache_dir / "templates" / f"{self.theme_hash}-{jinja2.__version__}"
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._engine = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(self.theme_path.absolute()),
+                autoescape=True,
+                bytecode_cache=jinja2.FileSystemBytecodeCache(str(cache_dir)))
+        return self._engine
+
+    @property
+    def page_tmpl(self) -> jinja2.Template:
+        if self._page_tmpl is None:
+            self._page_tmpl = self.engine.get_template("page.j2")
+        return self._page_tmpl
+
+    def create_pool(self) -> ProcessPoolExecutor:
+        """ Create a pool of processes with a PageBuilder in each of them, see get_worker_builder """
+        # multiprocessing is slow to import
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(
+            max_workers=self.config.jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.config, get_started(), logger.getEffectiveLevel(), self.theme_hash))
+
+    def get_page_count(self, meta: Meta) -> int:
+        """ Number of the pages for the directory, large directories are split by config.page_size entries """
+        total = len(meta.directories) + len(meta.files)
+        if not self.config.page_size or total <= self.config.page_size:
+            return 1
+        return math.ceil(total / self.config.page_size)
+
+    def render_pages(self, meta: Meta) -> Generator[tuple[str, str], None, None]:
+        """ Render the pages of the directory one by one, yields (file name, content) """
+        page_hash = self.get_page_hash(meta)
+        for page in range(1, self.get_page_count(meta) + 1):
+            yield self.config.get_page_file(page), self.render_page(meta, page=page, page_hash=page_hash)
+
+    def create_index_file(self, meta: Meta, output_file: Path, force: bool = False,
+                          page_content: str | None = None) -> bool:
+        """ Write the index file, if its content was changed. Returns True if the file was written. """
         if not force and output_file.exists():
             raise OSError(f"File exists: {output_file}")
-        page_tmpl = self.engine.get_template("page.j2")
+        if page_content is None:
+            page_content = self.render_page(meta)
+        changed = FileUtil.write_if_changed(output_file, page_content, normalize=PageBuilder.strip_generated_on)
+        if changed:
+            logger.debug("Write file: %s", output_file)
+        return changed
+
+    @staticmethod
+    def strip_generated_on(content: bytes) -> bytes:
+        """ Remove lines with the generation time, they are different for each build """
+        return b"\n".join(line for line in content.split(b"\n") if b"generated on" not in line.lower())
+
+    def get_page_hash(self, meta: Meta) -> str:
+        total_hash = [p.name for p in meta.directories]
+        total_hash.extend(p.page_hash for p in meta.files)
+        return self.hash_util.get_hash("".join(total_hash))
+
+    def _get_page_links(self, page: int, page_count: int) -> list[dict]:
+        """ Links to the first, last and nearby pages, None is a gap between them """
+        numbers = sorted({1, page_count, *range(max(1, page - 3), min(page_count, page + 3) + 1)})
+        links: list[dict] = []
+        for number in numbers:
+            if links and number - links[-1]["number"] > 1:
+                links.append({"number": None, "path": "", "current": False})
+            path = "./" if number == 1 else f"./{self.config.get_page_file(number)}"
+            links.append({"number": number, "path": path, "current": number == page})
+        return links
+
+    def _get_items(self, meta: Meta, page_files: list[FileInfo]) -> list[PageItem]:
+        """ Items of the page for the Jinja template """
         items: list[PageItem] = []
-        total_hash: list[str] = []
         if meta.depth > 0:
             item = PageItem(
                 name="..", path="..",
-                icon=f"{'../' * meta.depth}assets/icons/back.png",
+                icon=f"{'../' * meta.depth}{self.asset_url('icons/back.png')}",
                 size="-", type="go back",
                 created="-", modified="-")
-            logger.debug(f"ITEM: {item}")
+            logger.debug("ITEM: %s", item)
             items.append(item)
-        for p in meta.directories:
-            item = PageItem.from_file_info(p, meta=meta)
-            logger.debug(f"ITEM: {item}")
+        for p in page_files:
+            item = PageItem.from_file_info(p, meta=meta, asset_url=self.asset_url)
+            logger.debug("ITEM: %s", item)
             items.append(item)
-            total_hash.append(p.name)
-        for p in meta.files:
-            item = PageItem.from_file_info(p, meta=meta)
-            logger.debug(f"ITEM: {item}")
-            items.append(item)
-            total_hash.append(p.hash)
+        return items
 
+    def render_page(self, meta: Meta, page: int = 1, page_hash: str | None = None) -> str:
+        started = STATS.start()
+        page_count = self.get_page_count(meta)
+        first, last = 0, len(meta.directories) + len(meta.files)
+        if page_count > 1:
+            first = (page - 1) * self.config.page_size
+            last = min(last, first + self.config.page_size)
         dir_count = len(meta.directories)
         file_count = len(meta.files)
-        page_hash = self.hash_util.get_hash("".join(total_hash))
+        page_files = meta.directories[first:last] + meta.files[max(0, first - dir_count):max(0, last - dir_count)]
+
+        page_hash = page_hash or self.get_page_hash(meta)
         page_size = FileUtil.size_format(meta.size, round=True)
         page_id = f"{page_hash[:8]}-d{dir_count}f{file_count}-{page_size.lower()[:-1]}"
         path = "" if str(meta.path) in ("/", ".") else str(meta.path)
-        page_content = page_tmpl.render({
+        context = {
             "title": f"{self.config.name}: {path}" if path else self.config.name,
             "config": self.config,
-            "items": items,
             "path": str(Path("/") / path),
             "relpath": "./" + "../" * meta.depth,
             "app_name": self.config.APP_NAME,
             "app_version": self.config.APP_VERSION,
             "name": self.config.name,
             "display_name": self.config.display_name,
-            "datetime_iso": STARTED_ISO,
-            "datetime_ts": int(STARTED.timestamp()),
+            "datetime_iso": get_started().isoformat()[:19],
+            "datetime_ts": int(get_started().timestamp()),
             "hash": page_hash,
             "page_id": page_id,
             "path_size": meta.size,
             "path_size_fmt": page_size,
-        })
-        output_file.open("w").write(page_content)
-        logger.info(f"Write file: {output_file}")
+            "page": page,
+            "page_count": page_count,
+            "page_links": self._get_page_links(page, page_count) if page_count > 1 else [],
+            "asset": self.asset_url,
+        }
+        if self.renderer:
+            content = self.renderer.render(context, meta, page_files)
+        else:
+            context["items"] = self._get_items(meta, page_files)
+            content = self.page_tmpl.render(context)
+        STATS.stop("render", started, pages=1, files=len(page_files))
+        return content
 
-    def copy_assets(self) -> None:
+    def copy_assets(self) -> list[Path]:
+        """ Copy the theme assets with their original and fingerprinted names. The assets are compared by
+        the content hashes from the asset manifest of the previous build, so unchanged files are not read.
+        Fingerprinted files of the previous versions are removed. Returns the changed files.
+        """
         src = self.theme_path / self.config.assets_dir
         dest = self.config.output / self.config.assets_dir
+        manifest_path = dest / PageBuilder.ASSET_MANIFEST
         logger.info(f"Copy assets directory: {src}")
-        FileUtil.copy(src, dest)
+        try:
+            prev_assets = json.loads(manifest_path.read_text(encoding="utf-8")).get("assets", {})
+        except (OSError, ValueError, AttributeError):
+            prev_assets = {}
+        changed: list[Path] = []
+        hardlink = self.config.assets_mode == "hardlink"
+        for rel_path, asset in self.assets.items():
+            prev = prev_assets.get(rel_path) or {}
+            for target in (dest / rel_path, dest / asset["path"]):
+                try:
+                    is_same = prev.get("hash") == asset["hash"] and target.stat().st_size == asset["size"]
+                except FileNotFoundError:
+                    is_same = False
+                if not is_same:
+                    FileUtil.copy_file(src / rel_path, target, hardlink=hardlink)
+                    changed.append(target)
+        for rel_path, prev in prev_assets.items():
+            current = self.assets.get(rel_path)
+            if isinstance(prev, dict) and prev.get("path") and (current is None or current["path"] != prev["path"]):
+                stale = dest / prev["path"]
+                if stale.resolve().is_relative_to(dest.resolve()):
+                    logger.info(f"Remove old asset: {stale}")
+                    stale.unlink(missing_ok=True)
+                    stale.with_name(f"{stale.name}.gz").unlink(missing_ok=True)
+        content = json.dumps({"version": 1, "assets": self.assets}, indent=2, sort_keys=True)
+        if FileUtil.write_if_changed(manifest_path, content):
+            changed.append(manifest_path)
+        if self.config.gzip_level is not None:
+            files = [dest / p for rel_path, asset in self.assets.items() for p in (rel_path, asset["path"])
+                     if Path(p).suffix in PageBuilder.GZIP_SUFFIXES]
+            with ThreadPoolExecutor(max_workers=self.config.jobs, thread_name_prefix="gzip") as pool:
+                written = pool.map(FileUtil.write_gzip, files, [self.config.gzip_level] * len(files))
+                changed.extend(p.with_name(f"{p.name}.gz") for p, is_written in zip(files, written) if is_written)
+        return changed
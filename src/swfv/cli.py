@@ -10,32 +10,17 @@ import logging
 import os
 from pathlib import Path
 import sys
+import time
 
 sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
 from swfv.config import Config, ConfigFlag
-from swfv.core import process_dir
-from swfv.extra import cleanup
-
-logger = logging.getLogger()
+from swfv.utils.common import HashMode, HashUtil
+from swfv.utils.fs import FileType
 
+# modules of the commands are imported in their branches of run_cli: the builder imports Jinja,
+# the server imports http.server, so short commands (--version, --cleanup) start faster
 
-def _start_http_server(webroot: Path) -> int:
-    try:
-        from http.server import HTTPServer, SimpleHTTPRequestHandler
-        host = "localhost"
-        port = int(os.environ.get("HTTP_PORT", "8080"))
-        os.chdir(webroot.absolute())
-        print(f"Working directory:{Path.cwd()} ")
-        line_length = 80
-        print("*" * line_length)
-        print("*", "!!! WARNING !!!".center(line_length - 4), "*")
-        print("*", f"Web server was started: http://{host}:{port}".center(line_length - 4), "*")
-        print("*" * line_length)
-        httpd = HTTPServer((host, port), SimpleHTTPRequestHandler)
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    return 0
+logger = logging.getLogger()
 
 
 def run_cli(args: list[str] | None = None) -> int:
@@ -62,10 +47,75 @@ def run_cli(args: list[str] | None = None) -> int:
                         help="Do not show a confirmation prompt")
     parser.add_argument("--force", "-F", action="store_true",
                         help="Force overwrite of index.html files in the destination directory")
+    parser.add_argument("--incremental", "-I", action="store_true",
+                        help="Regenerate pages only for the directories changed since the previous build")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of parallel jobs for scanning, hashing and rendering (default: 1)")
+    parser.add_argument("--hash-algorithm", default=HashUtil.DEF_ALGORITHM, choices=HashUtil.algorithms(),
+                        help=f"Hash algorithm for the file checksums (default: {HashUtil.DEF_ALGORITHM})")
+    parser.add_argument("--hash-mmap", action="store_true",
+                        help="Read files through mmap to calculate hashes")
+    parser.add_argument("--hash", default=HashMode.FULL.value, choices=HashMode.values(),
+                        help="Hash mode for the files: none - no hashes, lazy - files are hashed when they are "
+                        "requested from the dynamic server, the builds use the known hashes, sampled - hash of "
+                        "the size and the head, middle and tail blocks, full - hash of the whole content "
+                        "(default: full)")
+    parser.add_argument("--hash-full-limit", default="0", metavar="SIZE",
+                        help="Use the sampled hash for files larger than SIZE, e.g. 1G (default: no limit)")
+    parser.add_argument("--hash-sampled-types", default="", metavar="TYPES",
+                        help=f"Use the sampled hash for these file types: {','.join(FileType.values())}")
+    parser.add_argument("--file-types", default="", metavar="EXT=TYPE,...",
+                        help="Custom file types for the extensions, e.g. ipynb=code,log=text")
+    parser.add_argument("--gzip", type=int, nargs="?", const=9, choices=range(1, 10), metavar="LEVEL",
+                        help="Write gzip compressed copies (.gz) of the pages, .meta and theme assets "
+                        "with the compression LEVEL 1-9 (default: 9)")
+    parser.add_argument("--meta-compact", action="store_true",
+                        help="Write .meta files as minified JSON with epoch timestamps")
+    parser.add_argument("--tree-index", choices=list(Config.TREE_INDEX_FORMATS),
+                        help="Write the index of the whole tree to one file in the destination directory: "
+                        f"{Config.DEF_TREE_INDEX_FILE}.ndjson (one JSON record per line) or "
+                        f"{Config.DEF_TREE_INDEX_FILE}.db (sqlite3 table 'entries')")
+    parser.add_argument("--search", action="store_true",
+                        help=f"Write the search index of the file names ({Config.DEF_SEARCH_DIR}) and add a search box to the pages")
+    parser.add_argument("--no-thumbnails", action="store_true",
+                        help=f"Don't create thumbnails of the images ({Config.DEF_THUMBS_DIR}), "
+                        "they are created only if Pillow is installed")
+    parser.add_argument("--assets-mode", default=Config.ASSETS_MODES[0], choices=Config.ASSETS_MODES,
+                        help="Copy the theme assets or make hard links to them, fingerprinted copies "
+                        "(css/site.<hash>.css) are referenced by the pages (default: copy)")
+    parser.add_argument("--symlinks", default=Config.SYMLINK_MODES[0], choices=Config.SYMLINK_MODES,
+                        help="Symlinks to directories: follow - process them (every directory is processed once), "
+                        "link - list them without processing, skip - ignore all symlinks (default: follow)")
+    parser.add_argument("--one-file-system", "-x", action="store_true",
+                        help="List directories on other filesystems (mount points) without processing them")
+    parser.add_argument("--page-size", type=int, default=Config.DEF_PAGE_SIZE, metavar="N",
+                        help="Split listings of the directories with more than N entries into pages "
+                        f"index.html, index-2.html, ..., 0 - no pages (default: {Config.DEF_PAGE_SIZE})")
     parser.add_argument("--cleanup", "-C", action="store_true",
                         help="Cleanup in the desctination directory, remove all generated files")
+    parser.add_argument("--watch", "-W", action="store_true",
+                        help="Build the site and keep it up to date with the changes in the source directory")
+    parser.add_argument("--watch-delay", type=float, default=2.0, metavar="SECONDS",
+                        help="Delay to collect the changes before update in the watch mode (default: 2.0)")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print a JSON report with timers and counters of the build phases")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Write cProfile data of the build to FILE (only the main process with --jobs > 1), "
+                        "view it with: python -m pstats FILE")
+    parser.add_argument("--cache-gc", type=int, nargs="?", const=30, metavar="DAYS",
+                        help="Delete cached hashes of removed files and files not seen for DAYS days (default: 30)")
     parser.add_argument("--serve", "-S", action="store_true",
                         help="Starts a basic HTTP server that serves files from the destination directory.")
+    parser.add_argument("--host", default=os.environ.get("HTTP_HOST", "localhost"),
+                        help="Address to bind the HTTP server (default: localhost)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("HTTP_PORT", "8080")),
+                        help="Port of the HTTP server (default: 8080)")
+    parser.add_argument("--dynamic", action="store_true",
+                        help="Serve the source directory and render pages on demand, without writing files")
+    parser.add_argument("--page-cache-size", type=int, default=1024, metavar="N",
+                        help="Number of the rendered pages cached in memory in the dynamic mode (default: 1024)")
+    parser.add_argument("--max-connections", type=int, default=64, metavar="N",
+                        help="Maximum number of the concurrent HTTP connections (default: 64)")
     parser.add_argument("--version", "-v", action="store_true",
                         help="Displays the current version of the tool")
     parser.add_argument("--theme", "-T", default="default",
@@ -91,14 +141,44 @@ def run_cli(args: list[str] | None = None) -> int:
                 display_name=pargs.display_name,
                 quiet=pargs.quiet,
                 force=pargs.force,
+                incremental=pargs.incremental,
+                jobs=pargs.jobs,
+                hash_algorithm=pargs.hash_algorithm,
+                hash_mmap=pargs.hash_mmap,
+                hash_mode=pargs.hash,
+                hash_full_limit=pargs.hash_full_limit,
+                hash_sampled_types=[v.strip() for v in pargs.hash_sampled_types.split(",") if v.strip()],
+                file_types=dict(v.split("=", 1) for v in pargs.file_types.split(",") if "=" in v),
+                gzip_level=pargs.gzip,
+                meta_compact=pargs.meta_compact,
+                tree_index=pargs.tree_index,
+                search_index=pargs.search,
+                page_size=pargs.page_size,
+                thumbnails=not pargs.no_thumbnails,
+                stats=pargs.stats,
+                assets_mode=pargs.assets_mode,
+                symlinks=pargs.symlinks,
+                one_file_system=pargs.one_file_system,
                 theme=pargs.theme,
                 flags=[v.strip().lower() for v in (pargs.flag or "").split(",") if v])
     logger.debug(f"Configuration: {cfg}")
     if pargs.cleanup:
+        from swfv.extra import cleanup
         return cleanup(cfg.output, config=cfg)
 
+    if pargs.cache_gc is not None:
+        from swfv.extra import cache_gc
+        return cache_gc(config=cfg, max_age_days=pargs.cache_gc)
+
+    if pargs.serve and pargs.dynamic:
+        from swfv.server import serve_dynamic
+        return serve_dynamic(cfg, host=pargs.host, port=pargs.port, max_connections=pargs.max_connections,
+                             cache_size=pargs.page_cache_size)
+
     if pargs.serve or str(pargs.source).lower().strip() in ("serve", "server"):
-        return _start_http_server(cfg.output)
+        from swfv.server import serve
+        return serve(cfg.output, host=pargs.host, port=pargs.port, max_connections=pargs.max_connections,
+                     meta_file=cfg.meta_file, index_file=cfg.index_file)
 
     if not cfg.quiet:
         answer = (input(f"Continue in '{cfg.source}' (y/N)? ") or "No").lower().strip()
@@ -106,7 +186,29 @@ def run_cli(args: list[str] | None = None) -> int:
             print(f"Answer is '{answer}'. Exit.")
             return 1
 
-    process_dir(cfg.source, config=cfg)
+    if pargs.watch:
+        from swfv.watch import watch
+        return watch(cfg, delay=pargs.watch_delay)
+
+    from swfv.core import process_dir
+    from swfv.utils.stats import STATS
+    STATS.enabled = cfg.stats
+    profiler = None
+    if pargs.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    started = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        process_dir(cfg.source, config=cfg)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(pargs.profile)
+            logger.info(f"Profile data was saved to {pargs.profile}")
+    if cfg.stats:
+        print(json.dumps(STATS.report(time.perf_counter() - started), indent=2))
     return 0
 
 def main(args: list[str] | None = None) -> int:
@@ -5,10 +5,14 @@ from enum import Enum
 import json
 import logging
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, ClassVar, Union
 
 
-from swfv.utils.common import BaseJsonEncoder
+from swfv.utils.common import BaseJsonEncoder, HashMode, HashUtil
+from swfv.utils.fs import FileType, FileUtil
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
 
 logger = logging.getLogger()
 __app_name__ = "swfv"
@@ -51,6 +55,19 @@ class Config:
     DEF_THUMBS_DIR = ".thumbs"
     DEF_ASSETS_DIR = "assets"
     DEF_INDEX_FILE = "index.html"
+    DEF_MANIFEST_FILE = ".manifest"
+    DEF_CHANGES_FILE = ".changes"
+    DEF_TREE_INDEX_FILE = ".index"
+    DEF_SEARCH_DIR = ".search"
+    DEF_PAGE_SIZE = 5000
+    # the marker is on the last line of the generated pages, the pages of the users don't have it
+    PAGE_MARKER = b"generated on"
+    ASSETS_MODES = ("copy", "hardlink")
+    # length of the content hash in the names of the fingerprinted assets (css/site.3f2a9c1d.css)
+    ASSETS_FINGERPRINT_LENGTH = 8
+    # follow - process the directories of the symlinks, link - list them without processing, skip - ignore symlinks
+    SYMLINK_MODES = ("follow", "link", "skip")
+    TREE_INDEX_FORMATS: ClassVar[dict[str, str]] = {"ndjson": ".ndjson", "sqlite": ".db"}
 
     def __init__(self,                                          # noqa: PLR0913
                  source: Union[str, Path, None] = None,
@@ -60,6 +77,24 @@ class Config:
                  display_name: str = __app_name__,
                  quiet: bool = False,
                  force: bool = False,
+                 incremental: bool = False,
+                 jobs: int = 1,
+                 hash_algorithm: str | None = None,
+                 hash_mmap: bool = False,
+                 hash_mode: str | HashMode | None = None,
+                 hash_full_limit: str | int | None = None,
+                 hash_sampled_types: list[str] | None = None,
+                 file_types: dict[str, str] | None = None,
+                 gzip_level: int | None = None,
+                 meta_compact: bool = False,
+                 tree_index: str | None = None,
+                 search_index: bool = False,
+                 page_size: int = DEF_PAGE_SIZE,
+                 thumbnails: bool = True,
+                 stats: bool = False,
+                 assets_mode: str | None = None,
+                 symlinks: str | None = None,
+                 one_file_system: bool = False,
                  theme: str | None = None,
                  flags: list[str] | None = None) -> None:
         self.source = Path(source or Path.cwd())
@@ -71,10 +106,44 @@ class Config:
         self.meta_file = Config.DEF_META_FILE
         self.thumbs_dir = Config.DEF_THUMBS_DIR
         self.assets_dir = Config.DEF_ASSETS_DIR
-        self.hash_file = Config.DEF_HASH_FILE
+        self.hash_algorithm = HashUtil.parse_algorithm(hash_algorithm)
+        self.hash_mmap = hash_mmap
+        self.hash_mode = HashMode.parse(hash_mode)
+        self.hash_full_limit = FileUtil.size_parse(hash_full_limit)
+        self.hash_sampled_types = [FileType.parse(v) for v in hash_sampled_types or []]
+        self.file_types = {k.strip().lower().lstrip("."): FileType.parse(v) for k, v in (file_types or {}).items()}
+        self.hash_file = Config.get_hash_file(self.hash_algorithm)
         self.index_file = Config.DEF_INDEX_FILE
+        self.manifest_file = Config.DEF_MANIFEST_FILE
+        self.changes_file = Config.DEF_CHANGES_FILE
+        self.meta_compact = meta_compact
+        self.tree_index = (tree_index or "").strip().lower() or None
+        if self.tree_index and self.tree_index not in Config.TREE_INDEX_FORMATS:
+            raise ValueError(f"Can't find '{tree_index}' in the tree index formats: {list(Config.TREE_INDEX_FORMATS)}")
+        self.tree_index_file = Config.DEF_TREE_INDEX_FILE + Config.TREE_INDEX_FORMATS.get(self.tree_index or "", "")
+        self.search_index = search_index
+        self.search_dir = Config.DEF_SEARCH_DIR
+        # directories with more entries are split into pages: index.html, index-2.html, ...
+        self.page_size = max(0, int(page_size or 0))
+        # thumbnails of the images are created if Pillow is installed
+        self.thumbnails = thumbnails
+        # timers and counters of the build phases are collected for the report
+        self.stats = stats
+        # theme assets are copied or linked (if the theme and the output are on the same filesystem)
+        self.assets_mode = (assets_mode or "").strip().lower() or Config.ASSETS_MODES[0]
+        if self.assets_mode not in Config.ASSETS_MODES:
+            raise ValueError(f"Can't find '{assets_mode}' in the assets modes: {list(Config.ASSETS_MODES)}")
+        self.symlinks = (symlinks or "").strip().lower() or Config.SYMLINK_MODES[0]
+        if self.symlinks not in Config.SYMLINK_MODES:
+            raise ValueError(f"Can't find '{symlinks}' in the symlink modes: {list(Config.SYMLINK_MODES)}")
+        # directories on other filesystems (mount points) are listed, but not processed
+        self.one_file_system = one_file_system
         self.quiet = quiet
         self.force = force
+        self.incremental = incremental
+        self.jobs = max(1, int(jobs or 1))
+        # gzip compressed copies of the generated files are written if the level is set
+        self.gzip_level = None if gzip_level is None else min(9, max(1, int(gzip_level)))
         self.theme = theme or "default"
 
         self.flags: list[ConfigFlag] = []
@@ -95,13 +164,92 @@ class Config:
             "meta_file": self.meta_file,
             "assets_dir": self.assets_dir,
             "hash_file": self.hash_file,
+            "hash_algorithm": self.hash_algorithm,
+            "hash_mmap": self.hash_mmap,
+            "hash_policy": self.hash_policy,
+            "file_types": {k: v.value for k, v in self.file_types.items()},
             "index_file": self.index_file,
+            "manifest_file": self.manifest_file,
+            "changes_file": self.changes_file,
+            "meta_compact": self.meta_compact,
+            "tree_index": self.tree_index,
+            "tree_index_file": self.tree_index_file,
+            "search_index": self.search_index,
+            "search_dir": self.search_dir,
+            "page_size": self.page_size,
+            "thumbnails": self.thumbnails,
+            "stats": self.stats,
+            "assets_mode": self.assets_mode,
+            "symlinks": self.symlinks,
+            "one_file_system": self.one_file_system,
             "quiet": self.quiet,
             "force": self.force,
+            "incremental": self.incremental,
+            "jobs": self.jobs,
+            "gzip_level": self.gzip_level,
             "theme": self.theme,
             "flags": [v.value for v in self.flags],
         }
 
+    @property
+    def hash_policy(self) -> dict:
+        res: dict = {"mode": self.hash_mode.value}
+        if self.hash_mode in (HashMode.FULL, HashMode.LAZY) and self.hash_full_limit:
+            res["full_limit"] = self.hash_full_limit
+        if self.hash_mode in (HashMode.FULL, HashMode.LAZY) and self.hash_sampled_types:
+            res["sampled_types"] = sorted(v.value for v in self.hash_sampled_types)
+        return res
+
+    def get_hash_mode(self, size: int, file_type: Callable[[], FileType], requested: bool = False) -> HashMode:
+        """ Get the hash mode for the file, the file type is requested only if it is needed.
+        In the lazy mode the limits of the full mode are applied to the requested files.
+        """
+        if self.hash_mode == HashMode.LAZY and not requested:
+            return self.hash_mode
+        if self.hash_mode not in (HashMode.FULL, HashMode.LAZY):
+            return self.hash_mode
+        if self.hash_full_limit and size > self.hash_full_limit:
+            return HashMode.SAMPLED
+        if self.hash_sampled_types and file_type() in self.hash_sampled_types:
+            return HashMode.SAMPLED
+        return HashMode.FULL
+
+    @staticmethod
+    def get_hash_file(algorithm: str) -> str:
+        """ Name of the checksum file for the hash algorithm """
+        return Config.DEF_HASH_FILE if algorithm == HashUtil.DEF_ALGORITHM else f".{algorithm}"
+
+    def get_page_file(self, page: int) -> str:
+        if page <= 1:
+            return self.index_file
+        stem, dot, ext = self.index_file.rpartition(".")
+        return f"{stem}-{page}{dot}{ext}" if dot else f"{self.index_file}-{page}"
+
+    def get_page_number(self, name: str) -> int | None:
+        """ Number of the page for the name of the generated page file, None for other files """
+        if name == self.index_file:
+            return 1
+        stem, dot, ext = self.index_file.rpartition(".")
+        prefix, suffix = (f"{stem}-", f"{dot}{ext}") if dot else (f"{self.index_file}-", "")
+        number = name[len(prefix):len(name) - len(suffix)]
+        if name.startswith(prefix) and name.endswith(suffix) and number.isdigit() and int(number) > 1:
+            return int(number)
+        return None
+
+    def is_generated_page(self, path: Path) -> bool:
+        """ Check if the file is a page written by the build or its gzip copy. index.html is always generated,
+        the other pages (index-2.html, ...) only if they have the marker, the pages of the users are kept.
+        """
+        page_path = path.with_name(path.name.removesuffix(".gz"))
+        page = self.get_page_number(page_path.name)
+        if page is None:
+            return False
+        return page == 1 or FileUtil.has_tail_marker(page_path, Config.PAGE_MARKER)
+
+    def is_page_file(self, name: str) -> bool:
+        """ Check if the name is a generated page file or its gzip copy """
+        return self.get_page_number(name.removesuffix(".gz")) is not None
+
     @property
     def flag_show_hidden(self) -> bool:
         return ConfigFlag.SHOW_HIDDEN in self.flags
@@ -1,71 +1,515 @@
 """
 """
 from __future__ import annotations
-import json
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 
 from pathlib import Path
+from stat import S_ISDIR
 
-from swfv.builder import PageBuilder
-from swfv.data import FileInfo, Meta, SWFVJsonEncoder
+from swfv.builder import PageBuilder, get_worker_builder
+from swfv.data import BuildManifest, FileInfo, Meta
+from swfv.index import TreeIndex
+from swfv.search import SearchIndex
+from swfv.thumbs import ThumbnailStage, is_available as is_thumbnails_available
+from swfv.utils.common import HashMode, HashUtil
 from swfv.utils.fs import FileUtil
+from swfv.utils.stats import STATS, Progress
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
+    import os
+    from collections.abc import Iterable
+    from concurrent.futures import ProcessPoolExecutor
+
     from swfv.config import Config
 
 logger = logging.getLogger()
 
+# prefix of the removed files in the changes file
+CHANGES_REMOVED_PREFIX = "- "
+
+class BuildPipeline:
+    """ Runs the build stages: scan directories, hash files, render and write pages.
+    With config.jobs > 1 scanning and hashing run on thread pools and rendering runs
+    on a process pool by batches, otherwise everything is done in the current thread.
+    If config.gzip_level is set, the written pages and .meta files are compressed on a thread pool.
+    Thumbnails of the images are created on their own process pool, if Pillow is installed.
+    """
+    RENDER_BATCH_SIZE = 16
+
+    def __init__(self, config: Config, builder: PageBuilder) -> None:
+        self.config = config
+        self.builder = builder
+        self.scan_pool: ThreadPoolExecutor | None = None
+        self.hash_pool: ThreadPoolExecutor | None = None
+        self.render_pool: ProcessPoolExecutor | None = None
+        self.compress_pool: ThreadPoolExecutor | None = None
+        self.hash_util = HashUtil(config.APP_NAME, algorithm=config.hash_algorithm, use_mmap=config.hash_mmap)
+        self.scans: dict[Path, Future] = {}
+        self.renders: dict[Path, Future] = {}
+        self.pending: dict[Future, list[Path]] = {}
+        self.changed: list[Path] = []
+        self.removed: list[Path] = []
+        self.render_batch: list[tuple[Meta, BuildManifest | None, bool]] = []
+        self.compressions: list[tuple[Future, Path]] = []
+        self.tree_index: TreeIndex | None = None
+        self.search_index: SearchIndex | None = None
+        self.thumbnails: ThumbnailStage | None = None
+        self.progress = Progress()
+        # (st_dev, st_ino) of the processed directories and of the directories being processed now (the path
+        # from the root), symlinked directories are processed once and loops (symlinks, bind mounts) are cut
+        self.visited: set[tuple[int, int]] = set()
+        self.ancestors: set[tuple[int, int]] = set()
+        self.root_dev = config.source.stat().st_dev
+        self.config_hash = BuildManifest.get_config_hash(config, assets_hash=builder.assets_hash)
+        FileUtil.register_file_types(config.file_types)
+        if config.thumbnails:
+            if is_thumbnails_available():
+                self.thumbnails = ThumbnailStage(config)
+            else:
+                logger.info("Pillow is not installed, thumbnails are not created")
+        if config.gzip_level is not None:
+            self.compress_pool = ThreadPoolExecutor(max_workers=config.jobs, thread_name_prefix="gzip")
+        if config.jobs > 1:
+            logger.info(f"Use {config.jobs} parallel jobs")
+            self.scan_pool = ThreadPoolExecutor(max_workers=config.jobs, thread_name_prefix="scan")
+            self.hash_pool = ThreadPoolExecutor(max_workers=config.jobs, thread_name_prefix="hash")
+            self.render_pool = builder.create_pool()
+
+    def scan(self, work_dir: Path, depth: int, prefetch: bool = True) -> tuple[list[tuple[Path, os.stat_result]],
+                                                                             list[tuple[Path, os.stat_result]]]:
+        future = self.scans.pop(work_dir, None)
+        dirs, files = future.result() if future else _scan_dir(work_dir, self.config, depth)
+        if self.scan_pool and prefetch:
+            # prefetch sub-directories, they will be processed next
+            for p, _ in dirs:
+                self.scans[p] = self.scan_pool.submit(_scan_dir, p, self.config, depth + 1)
+        return dirs, files
+
+    def is_followed(self, path: Path, stat: os.stat_result) -> bool:
+        """ Check if the sub-directory is processed with the symlink and filesystem options """
+        if self.config.one_file_system and stat.st_dev != self.root_dev:
+            logger.info(f"Directory is on another filesystem, it is not processed: {path}")
+            return False
+        if self.config.symlinks == "link" and path.is_symlink():
+            logger.debug("Directory is a symlink, it is not processed: %s", path)
+            return False
+        return True
+
+    def enter(self, path: Path, stat: os.stat_result) -> bool:
+        """ Check if the sub-directory has to be processed, leave() is called after processing it.
+        Real directories are always processed unless they are their own ancestors (a bind mount loop),
+        symlinked directories only if nothing was processed for them yet.
+        Directories which are not processed are listed in their parents with zero size.
+        """
+        key = (stat.st_dev, stat.st_ino)
+        if key in self.ancestors:
+            logger.warning(f"Directory is its own ancestor (symlink or bind mount loop), skip it: {path}")
+        elif key in self.visited and path.is_symlink():
+            logger.info(f"Directory of the symlink was processed already, skip it: {path}")
+        elif self.is_followed(path, stat):
+            self.visited.add(key)
+            self.ancestors.add(key)
+            return True
+        # drop the prefetched scan of the directory
+        self.scans.pop(path, None)
+        return False
+
+    def leave(self, stat: os.stat_result) -> None:
+        self.ancestors.discard((stat.st_dev, stat.st_ino))
+
+    def _create_file_info(self, item: tuple[Path, os.stat_result]) -> FileInfo:
+        return FileInfo(path=item[0], stat=item[1], hash_util=self.hash_util, config=self.config)
+
+    def create_file_infos(self, work_dir: Path, files: list[tuple[Path, os.stat_result]]) -> list[FileInfo]:
+        if not files:
+            return []
+        self.hash_util.prefetch(work_dir)
+        try:
+            if self.hash_pool:
+                return list(self.hash_pool.map(self._create_file_info, files))
+            return [self._create_file_info(item) for item in files]
+        finally:
+            self.hash_util.forget(work_dir)
+
+    def write(self, meta: Meta, manifest: BuildManifest | None, force: bool) -> None:
+        if self.tree_index:
+            self.tree_index.add_meta(meta)
+        if self.thumbnails:
+            has_thumbnails = self.thumbnails.add(meta, meta.output_file_path.parent)
+            meta.has_thumbnails = has_thumbnails and meta.is_media_directory()
+        if self.render_pool:
+            self.render_batch.append((meta, manifest, force))
+            if len(self.render_batch) >= BuildPipeline.RENDER_BATCH_SIZE:
+                self._submit_batch()
+        else:
+            changed, removed = _write_outputs([(meta, manifest, force)], builder=self.builder)
+            self.changed.extend(changed)
+            self.removed.extend(removed)
+            self.compress([meta.output_file_path.parent])
+
+    def keep(self, meta: Meta) -> None:
+        """ The directory was not changed, its generated files are kept """
+        if self.tree_index and not self.tree_index.update:
+            self.tree_index.add_meta_file(meta.path, meta.output_file_path)
+
+    def index(self, work_dir_rel: Path, manifest: BuildManifest, prev_manifest: BuildManifest | None) -> None:
+        """ Add the entries of the directory to the search index """
+        if self.search_index:
+            self.search_index.add(work_dir_rel, manifest, prev_manifest)
+
+    def open_indexes(self, update: bool = False, partial: bool = False) -> None:
+        """ Open the tree and search indexes. The tree index is written again by the full walk (partial=False),
+        the unchanged directories are added from their .meta files by keep().
+        """
+        self.tree_index = TreeIndex.create(self.config, update=partial)
+        if self.config.search_index:
+            self.search_index = SearchIndex(self.config, update=update)
+
+    def close_indexes(self, commit: bool = True) -> list[Path]:
+        """ Finish the tree and search indexes, returns the written files """
+        changed: list[Path] = []
+        tree_index, self.tree_index = self.tree_index, None
+        search_index, self.search_index = self.search_index, None
+        if tree_index and tree_index.close(commit=commit):
+            changed.append(tree_index.path)
+        if search_index:
+            changed.extend(search_index.close(commit=commit))
+        return changed
+
+    def compress(self, output_dirs: list[Path]) -> None:
+        """ Write gzip copies of the generated files, they are regenerated only if the files were changed """
+        if self.compress_pool is None or self.config.gzip_level is None:
+            return
+        for output_dir in output_dirs:
+            for name in (self.config.meta_file, *_get_page_files(output_dir, self.config)):
+                path = output_dir / name
+                future = self.compress_pool.submit(FileUtil.write_gzip, path, self.config.gzip_level)
+                self.compressions.append((future, path.with_name(f"{name}.gz")))
+
+    def _submit_batch(self) -> None:
+        if self.render_pool and self.render_batch:
+            self._collect()
+            if len(self.pending) >= self.config.jobs * 4:
+                # limit the number of directories waiting for rendering in the memory
+                next(iter(self.pending)).result()
+                self._collect()
+            future = self.render_pool.submit(_write_outputs_worker, self.render_batch)
+            output_dirs = [meta.output_file_path.parent for meta, _, _ in self.render_batch]
+            for output_dir in output_dirs:
+                self.renders[output_dir] = future
+            self.pending[future] = output_dirs
+            self.render_batch = []
+
+    def _collect(self, wait: bool = False) -> None:
+        """ Collect results of the finished batches """
+        for future in [f for f in self.pending if wait or f.done()]:
+            output_dirs = self.pending.pop(future)
+            for output_dir in output_dirs:
+                self.renders.pop(output_dir, None)
+            changed, removed, phases = future.result()
+            self.changed.extend(changed)
+            self.removed.extend(removed)
+            STATS.merge(phases)
+            self.compress(output_dirs)
+
+    def wait(self, output_dir: Path) -> None:
+        """ Wait until the files for output_dir are written """
+        if any(meta.output_file_path.parent == output_dir for meta, _, _ in self.render_batch):
+            self._submit_batch()
+        future = self.renders.get(output_dir)
+        if future:
+            future.result()
+
+    def finish(self) -> tuple[list[Path], list[Path]]:
+        """ Wait until all pages are written, returns the changed and the removed files """
+        self._submit_batch()
+        self._collect(wait=True)
+        compressions, self.compressions = self.compressions, []
+        self.changed.extend(gz_path for future, gz_path in compressions if future.result())
+        if self.thumbnails:
+            started = STATS.start()
+            self.changed.extend(self.thumbnails.finish())
+            STATS.stop("thumbnails", started)
+        changed, self.changed = self.changed, []
+        removed, self.removed = self.removed, []
+        return changed, removed
+
+    def close(self) -> None:
+        try:
+            self.finish()
+        finally:
+            for pool in (self.scan_pool, self.hash_pool, self.render_pool, self.compress_pool):
+                if pool:
+                    pool.shutdown(cancel_futures=True)
+            self.hash_util.close()
+            if self.thumbnails:
+                self.thumbnails.close()
+            self.close_indexes(commit=False)
+            self.renders.clear()
+            self.pending.clear()
+            self.scans.clear()
+
+
 def process_dir(work_dir: Path, config: Config, depth: int = 0) -> None:
     builder = PageBuilder(config=config)
-    _process_dir(work_dir, config, depth, builder)
-    builder.copy_assets()
+    pipeline = BuildPipeline(config=config, builder=builder)
+    try:
+        pipeline.open_indexes(update=config.incremental)
+        root_stat = Path(work_dir).stat()
+        pipeline.visited.add((root_stat.st_dev, root_stat.st_ino))
+        pipeline.ancestors.add((root_stat.st_dev, root_stat.st_ino))
+        _process_dir(work_dir, config, depth, pipeline)
+        changed, removed = pipeline.finish()
+        started = STATS.start()
+        changed += pipeline.close_indexes()
+        STATS.stop("indexes", started)
+        pipeline.progress.finish()
+    finally:
+        pipeline.close()
+    changed += builder.copy_assets()
+    _write_changes_file(changed, config, removed=removed)
+
+def update_dirs(dirs: Iterable[Path], config: Config, pipeline: BuildPipeline) -> list[Path]:
+    """ Regenerate files only for the directories (without sub-directories) and their parents.
+    The sizes of the sub-directories are taken from their build manifests, so config.incremental must be set.
+    Returns the changed files.
+    """
+    source = config.source.absolute()
+    targets: set[Path] = set()
+    for work_dir in dirs:
+        work_dir = Path(work_dir).absolute()
+        if work_dir != source and source not in work_dir.parents:
+            continue
+        targets.add(work_dir)
+        targets.update(p for p in work_dir.parents if p == source or source in p.parents)
+    pipeline.open_indexes(update=True, partial=True)
+    # sub-directories without manifests are processed recursively, every one of them once
+    pipeline.visited.clear()
+    pipeline.ancestors.clear()
+    try:
+        # children first, parents use their sizes
+        for work_dir in sorted(targets, key=lambda p: len(p.parts), reverse=True):
+            if work_dir.is_dir():
+                depth = len(work_dir.relative_to(source).parts)
+                _process_dir(config.source / work_dir.relative_to(source), config, depth, pipeline, recursive=False)
+        changed, removed = pipeline.finish()
+        changed += pipeline.close_indexes()
+    finally:
+        pipeline.close_indexes(commit=False)
+    if changed or removed:
+        _write_changes_file(changed, config, removed=removed)
+    return changed
+
+def scan_meta(work_dir: Path, config: Config, hash_util: HashUtil, depth: int = 0) -> Meta:
+    """ Build Meta for one directory with a single scan, the sizes of the sub-directories are not calculated """
+    work_dir_rel = work_dir.relative_to(config.source)
+    meta = Meta(path=work_dir_rel,
+                output_file_path=config.output / work_dir_rel / config.meta_file,
+                depth=depth,
+                thumbnail_path=Path(config.thumbs_dir),
+                hash_algorithm=config.hash_algorithm,
+                hash_policy=config.hash_policy)
+    dirs, files = _scan_dir(work_dir, config, depth)
+    meta.directories = sorted((FileInfo(path=p, stat=st) for p, st in dirs), key=lambda x: x.name)
+    hash_util.prefetch(work_dir)
+    try:
+        meta.files = sorted((FileInfo(path=p, stat=st, hash_util=hash_util, config=config) for p, st in files),
+                            key=lambda x: x.name)
+    finally:
+        hash_util.forget(work_dir)
+        hash_util.flush()
+    meta.size = sum(fi.size for fi in meta.files)
+    return meta
+
+def _write_changes_file(changed: list[Path], config: Config, removed: list[Path] | None = None) -> None:
+    """ Write the list of the output files changed by the build, to sync only them.
+    The removed files are listed after them with the prefix '- ', changed files with names starting with '- '
+    are written with the prefix './'.
+    """
+    changes_file = config.output / config.changes_file
+    removed = removed or []
+    logger.info(f"Changed files: {len(changed)}, removed files: {len(removed)}, the list is in {changes_file}")
+    lines = [f"./{line}" if line.startswith(CHANGES_REMOVED_PREFIX) else line
+             for line in sorted(str(p.relative_to(config.output)) for p in changed)]
+    lines.extend(sorted(f"{CHANGES_REMOVED_PREFIX}{p.relative_to(config.output)}" for p in removed))
+    FileUtil.write_if_changed(changes_file, "".join(f"{line}\n" for line in lines))
 
-def _process_dir(work_dir: Path, config: Config, depth: int, builder: PageBuilder) -> Meta:
+def _scan_dir(work_dir: Path, config: Config, depth: int) -> tuple[list[tuple[Path, os.stat_result]],
+                                                                  list[tuple[Path, os.stat_result]]]:
+    started = STATS.start()
+    dirs: list[tuple[Path, os.stat_result]] = []
+    files: list[tuple[Path, os.stat_result]] = []
+    for p, st in FileUtil.scan(work_dir, symlinks=config.symlinks != "skip"):
+        if p.name.startswith(".") or \
+            p.name.startswith("__") or \
+                (depth == 0 and p.name == config.assets_dir):
+            continue
+        if S_ISDIR(st.st_mode):
+            dirs.append((p, st))
+        elif p.name not in (config.hash_file, config.meta_file, config.manifest_file) and \
+                not (config.is_page_file(p.name) and config.is_generated_page(p)):
+            files.append((p, st))
+    STATS.stop("scan", started, dirs=1, entries=len(dirs) + len(files))
+    return dirs, files
+
+def _is_up_to_date(manifest: BuildManifest, prev_manifest: BuildManifest | None,
+                   output_dir: Path, config: Config) -> bool:
+    if prev_manifest is None or prev_manifest != manifest:
+        return False
+    return (output_dir / config.meta_file).exists() and (output_dir / config.index_file).exists()
+
+def _get_dir_size(work_dir: Path, output_dir: Path, config: Config, depth: int, pipeline: BuildPipeline) -> int:
+    """ Get the size of the directory from its build manifest, or process the directory if it has no manifest """
+    pipeline.wait(output_dir)
+    manifest = BuildManifest.load(output_dir / config.manifest_file)
+    if manifest is not None:
+        return manifest.size
+    return _process_dir(work_dir, config, depth, pipeline).size
+
+def _process_dir(work_dir: Path, config: Config, depth: int, pipeline: BuildPipeline,
+                 recursive: bool = True) -> Meta:
     tab = "." * depth
     try:
         work_dir = Path(work_dir)
         work_dir_rel = work_dir.relative_to(config.source)
         output_dir = config.output / work_dir_rel
-        logger.info(f"{tab}Processing {work_dir_rel} to {output_dir} (level={depth})...")
-        # thumbnail_dir = output_dir / config.thumbs_dir
+        logger.debug("%sProcessing %s to %s (level=%d)...", tab, work_dir_rel, output_dir, depth)
         meta = Meta(path=work_dir_rel,
                     output_file_path = output_dir / config.meta_file,
                     depth=depth,
-                    thumbnail_path=Path(config.thumbs_dir))
-        for p in FileUtil.search(work_dir):
-            if p.name.startswith(".") or \
-                p.name.startswith("__") or \
-                    (depth == 0 and p.name == config.assets_dir):
-                continue
-            if p.is_dir():
-                dir_meta = _process_dir(p, config, depth + 1, builder)
-                fi = FileInfo(path=p)
-                fi.size = dir_meta.size
-                meta.directories.append(fi)
-                meta.size += fi.size
-            elif p.name not in (config.hash_file, config.meta_file, config.index_file):
-                logger.info(f"{tab}> File: {p.relative_to(config.source)}")
-                fi = FileInfo(path=p)
-                meta.files.append(fi)
-                meta.size += fi.size
+                    thumbnail_path=Path(config.thumbs_dir),
+                    hash_algorithm=config.hash_algorithm,
+                    hash_policy=config.hash_policy)
+        manifest = BuildManifest(config_hash=pipeline.config_hash)
+        dirs, files = pipeline.scan(work_dir, depth, prefetch=recursive)
+        if recursive:
+            pipeline.progress.found(len(dirs))
+        for p, st in dirs:
+            if recursive and pipeline.enter(p, st):
+                try:
+                    dir_size = _process_dir(p, config, depth + 1, pipeline).size
+                finally:
+                    pipeline.leave(st)
+            elif recursive:
+                dir_size = 0
+            elif pipeline.is_followed(p, st):
+                dir_size = _get_dir_size(p, output_dir / p.name, config, depth + 1, pipeline)
+            else:
+                dir_size = 0
+            manifest.directories[p.name] = dir_size
+            manifest.size += dir_size
+        for p, stat in files:
+            manifest.files[p.name] = [stat.st_mtime_ns, stat.st_size]
+            manifest.size += stat.st_size
+        prev_manifest = BuildManifest.load(output_dir / config.manifest_file) if config.incremental else None
+        pipeline.index(work_dir_rel, manifest, prev_manifest)
+        if _is_up_to_date(manifest, prev_manifest, output_dir, config):
+            logger.debug("%sDirectory %s was not changed, skip it", tab, work_dir_rel)
+            STATS.count("build", dirs=1, skipped=1)
+            meta.size = manifest.size
+            pipeline.keep(meta)
+            pipeline.progress.done(len(files), sum(st.st_size for _, st in files))
+            return meta
+        in_place = config.output == config.source
+        for p, st in dirs:
+            if in_place:
+                # generated files change the modification time of the directory, stat it again
+                pipeline.wait(output_dir / p.name)
+            fi = FileInfo(path=p, stat=None if in_place else st)
+            fi.size = manifest.directories[p.name]
+            meta.directories.append(fi)
+            meta.size += fi.size
+        if logger.isEnabledFor(logging.DEBUG):
+            for p, _ in files:
+                logger.debug("%s> File: %s", tab, p.relative_to(config.source))
+        started = STATS.start()
+        for fi in pipeline.create_file_infos(work_dir, files):
+            meta.files.append(fi)
+            meta.size += fi.size
+        STATS.stop("files", started, dirs=1, files=len(files))
         meta.directories.sort(key=lambda x:x.name)
         meta.files.sort(key=lambda x:x.name)
-        # print(f"META ({meta.output_file_path}) = {meta}")
-        logger.info(f"{tab}Create meta file: {meta.output_file_path}")
-        meta.output_file_path.parent.mkdir(parents=True, exist_ok=True)
-        with meta.output_file_path.open("wt") as writer:
-            json.dump(meta.to_dict(), fp=writer, indent=2, cls=SWFVJsonEncoder)
-        index_file_path = meta.output_file_path.parent / config.index_file
-        logger.info(f"{tab}Create index file: {index_file_path}")
-        builder.create_index_file(meta, index_file_path, force=config.force)
-        hash_file = meta.output_file_path.parent / config.hash_file
-        if meta.files:
-            logger.info(f"{tab}Create hash file: {hash_file}")
-            with hash_file.open("wt") as writer:
-                for fi in meta.files:
-                    writer.write(f"{fi.hash}  {fi.name}\n")
+        pipeline.write(meta, manifest if config.incremental else None,
+                       force=config.force or prev_manifest is not None)
+        STATS.count("build", dirs=1)
+        pipeline.progress.done(len(files), sum(st.st_size for _, st in files))
         return meta
 
     finally:
-        logger.info(f"{tab}Process {work_dir} (level={depth}) finished")
+        logger.debug("%sProcess %s (level=%d) finished", tab, work_dir, depth)
+
+def _get_page_files(output_dir: Path, config: Config) -> list[str]:
+    """ Names of the existing page files of the directory """
+    names = []
+    while (output_dir / config.get_page_file(len(names) + 1)).exists():
+        names.append(config.get_page_file(len(names) + 1))
+    return names
+
+def _remove_pages(output_dir: Path, config: Config, first_page: int) -> list[Path]:
+    """ Remove pages left from the previous build, when the directory had more pages. Returns the removed files.
+    Pages without the marker of the generated pages belong to the users, they are kept.
+    """
+    removed: list[Path] = []
+    page = first_page
+    while (output_dir / config.get_page_file(page)).exists():
+        page_file = output_dir / config.get_page_file(page)
+        page += 1
+        if not config.is_generated_page(page_file):
+            logger.info(f"Page file wasn't generated, keep it: {page_file}")
+            continue
+        logger.info(f"Remove page file: {page_file}")
+        page_file.unlink()
+        removed.append(page_file)
+        gz_file = page_file.with_name(f"{page_file.name}.gz")
+        if gz_file.exists():
+            gz_file.unlink()
+            removed.append(gz_file)
+    return removed
+
+
+def _write_outputs(items: list[tuple[Meta, BuildManifest | None, bool]],
+                   builder: PageBuilder | None = None) -> tuple[list[Path], list[Path]]:
+    """ Write .meta, index and hash files for the directories. Returns the changed and the removed files. """
+    builder = builder or get_worker_builder()
+    config = builder.config
+    changed: list[Path] = []
+    removed: list[Path] = []
+    for meta, manifest, force in items:
+        tab = "." * meta.depth
+        output_dir = meta.output_file_path.parent
+        # print(f"META ({meta.output_file_path}) = {meta}")
+        # the checksum file of the algorithm of the previous build is removed, if the algorithm was changed
+        prev_algorithm = Meta.read_hash_algorithm(meta.output_file_path)
+        if prev_algorithm != meta.hash_algorithm and prev_algorithm in HashUtil.algorithms():
+            prev_hash_file = output_dir / config.get_hash_file(prev_algorithm)
+            if prev_hash_file.exists():
+                prev_hash_file.unlink()
+                removed.append(prev_hash_file)
+        logger.debug("%sCreate meta file: %s", tab, meta.output_file_path)
+        if FileUtil.write_if_changed(meta.output_file_path, meta.dumps(compact=config.meta_compact)):
+            changed.append(meta.output_file_path)
+        page_count = 0
+        for page_file, page_content in builder.render_pages(meta):
+            page_count += 1
+            index_file_path = output_dir / page_file
+            logger.debug("%sCreate index file: %s", tab, index_file_path)
+            if builder.create_index_file(meta, index_file_path, force=force, page_content=page_content):
+                changed.append(index_file_path)
+        removed.extend(_remove_pages(output_dir, config, first_page=page_count + 1))
+        hash_file = output_dir / config.hash_file
+        # sampled hashes are not checksums, they can't be checked by md5sum
+        hashed_files = [fi for fi in meta.files if fi.hash_mode == HashMode.FULL]
+        if hashed_files:
+            logger.debug("%sCreate hash file: %s", tab, hash_file)
+            if FileUtil.write_if_changed(hash_file, "".join(f"{fi.hash}  {fi.name}\n" for fi in hashed_files)):
+                changed.append(hash_file)
+        if manifest:
+            manifest.save(output_dir / config.manifest_file)
+        meta.release()
+    return changed, removed
+
+def _write_outputs_worker(items: list[tuple[Meta, BuildManifest | None, bool]]) -> tuple[list[Path], list[Path], dict]:
+    """ _write_outputs in the worker process, the statistics of the worker are returned with the changed files """
+    return (*_write_outputs(items), STATS.take())
@@ -4,16 +4,23 @@ from __future__ import annotations
 from datetime import datetime, timezone
 from enum import Enum
 import json
-import mimetypes
+import logging
+import re
+from stat import S_ISDIR
 from typing import TYPE_CHECKING
 
 from swfv.config import Config
-from swfv.utils.common import BaseJsonEncoder, HashUtil
+from swfv.thumbs import is_enabled as is_thumbnails_enabled
+from swfv.utils.common import BaseJsonEncoder, HashMode, HashUtil
 from swfv.utils.fs import FileType, FileUtil
+from swfv.utils.stats import STATS
 
 if TYPE_CHECKING:
+    import os
     from pathlib import Path
 
+logger = logging.getLogger()
+
 class SWFVJsonEncoder(BaseJsonEncoder):
     def default(self, obj: object) -> object:
         if isinstance(obj, (Meta, FileInfo)):
@@ -23,38 +30,87 @@ class SWFVJsonEncoder(BaseJsonEncoder):
         return super().default(obj)
 
 class FileInfo:
+    """ File or directory record. The slots keep the instance small, the timestamps are stored as ints,
+    and mime, type and thumbnail names are calculated on the first access.
+    """
+    __slots__ = ("_mime", "_path", "_type", "created_ts", "file", "hash", "hash_mode",
+                 "modified_ts", "name", "size")
+
     HASH = HashUtil(app_name=Config.APP_NAME)
 
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, stat: os.stat_result | None = None, hash_util: HashUtil | None = None,
+                 config: Config | None = None) -> None:
         self._path = path
-        self.file = not self._path.is_dir()
+        stat = stat or self._path.stat()
+        self.file = not S_ISDIR(stat.st_mode)
         self.name = self._path.name
-        stat = self._path.stat()
-        self.created = datetime.fromtimestamp(int(stat.st_ctime or 0), tz=timezone.utc)
-        self.modified = datetime.fromtimestamp(int(stat.st_mtime or 0), tz=timezone.utc)
+        self.created_ts = int(stat.st_ctime or 0)
+        self.modified_ts = int(stat.st_mtime or 0)
+        self._mime: str | None = None
+        self._type: FileType | None = None
         if self.file:
             self.size = stat.st_size
-            self.hash = FileInfo.HASH.get_hash_from_file(self._path)
-            self.ext = self._path.suffix[1:].lower()
-            self.mime = (mimetypes.guess_type(self._path)[0] or "").lower()
-            self.type = FileUtil.get_file_type(path=self._path, ext=self.ext, mime=self.mime)
+            self.hash_mode = config.get_hash_mode(self.size, lambda: self.type) if config else HashMode.FULL
+            self.hash = (hash_util or FileInfo.HASH).get_hash_from_file(self._path, stat=stat, mode=self.hash_mode)
+            if self.hash_mode == HashMode.LAZY and self.hash:
+                # the file was hashed already (on a request or by a full build), it is the full hash
+                self.hash_mode = HashMode.FULL
         else:
             self.size = 0
             self.hash = None
-            self.ext = None
-            self.mime = None
-            self.type = FileType.DIRECTORY
-        base_name = FileUtil.normilize_file_name(f"{self._path.stem}")
-        self.thumbnail_sm = f"{self.type.value.lower()}.png"
-        self.thumbnail_md = f"{base_name}.md.jpg"
-        self.thumbnail_lg = f"{base_name}.lg.jpg"
+            self.hash_mode = HashMode.NONE
+            self._type = FileType.DIRECTORY
+
+    @property
+    def created(self) -> datetime:
+        return datetime.fromtimestamp(self.created_ts, tz=timezone.utc)
+
+    @property
+    def modified(self) -> datetime:
+        return datetime.fromtimestamp(self.modified_ts, tz=timezone.utc)
+
+    @property
+    def ext(self) -> str | None:
+        return self._path.suffix[1:].lower() if self.file else None
+
+    @property
+    def mime(self) -> str | None:
+        if self._mime is None and self.file:
+            self._mime = FileUtil.get_mime_type(self.name)
+        return self._mime
+
+    @property
+    def type(self) -> FileType:
+        if self._type is None:
+            started = STATS.start()
+            self._type = FileUtil.get_file_type(path=self._path, ext=self.ext, mime=self.mime)
+            STATS.stop("type", started, files=1)
+        return self._type
+
+    @property
+    def thumbnail_sm(self) -> str:
+        return f"{self.type.value.lower()}.png"
+
+    @property
+    def thumbnail_md(self) -> str:
+        return f"{FileUtil.normilize_file_name(self._path.stem)}.md.jpg"
+
+    @property
+    def thumbnail_lg(self) -> str:
+        return f"{FileUtil.normilize_file_name(self._path.stem)}.lg.jpg"
 
     @property
     def path_real(self) -> Path:
         return self._path
 
-    def to_dict(self) -> dict:
-        return {
+    @property
+    def page_hash(self) -> str:
+        """ Value for the page hash: the content hash or the name, size and mtime if the file is not hashed """
+        return self.hash or f"{self.name}-{self.size}-{self.modified_ts}"
+
+    def to_dict(self, compact: bool = False) -> dict:
+        """ Dictionary for .meta, timestamps are epoch seconds in the compact form """
+        result = {
             "name": str(self.name),
             "file": self.file,
             "size": int(self.size or 0),
@@ -62,34 +118,49 @@ class FileInfo:
             "ext": self.ext,
             "type": self.type,
             "mime": self.mime,
-            "created": self.created,
-            "modified": self.modified,
+            "created": self.created_ts if compact else self.created,
+            "modified": self.modified_ts if compact else self.modified,
             "thumbnail": {
                 "sm": self.thumbnail_sm,
                 "md": self.thumbnail_md,
                 "lg": self.thumbnail_lg,
             },
         }
+        if self.hash_mode == HashMode.SAMPLED:
+            result["hash_sampled"] = True
+        return result
 
     def __str__(self) -> str:
         return json.dumps(self.to_dict(), cls=SWFVJsonEncoder)
 
 class Meta:
+    HASH_ALGORITHM_PATTERN = re.compile(rb'"hash_algorithm":\s*"([\w-]+)"')
+
     def __init__(self, path: Path, output_file_path: Path, depth: int = 0,
-                 thumbnail_path: Path | None = None) -> None:
+                 thumbnail_path: Path | None = None, hash_algorithm: str = HashUtil.DEF_ALGORITHM,
+                 hash_policy: dict | None = None) -> None:
         self.path = path
         self.output_file_path = output_file_path
         self.files: list[FileInfo] = []
         self.directories: list[FileInfo] = []
         self.size = 0
         self.depth = depth
+        self.hash_algorithm = hash_algorithm
+        self.hash_policy = hash_policy or {"mode": HashMode.FULL.value}
         self.thumbnail_sm = None
         self.thumbnail_md = None
         self.thumbnail_lg = None
         self.thumbnail_dir = None
+        # thumbnails of the images are shown on the page, it is set by the build pipeline
+        self.has_thumbnails = False
         if thumbnail_path:
             self.thumbnail_dir = thumbnail_path
 
+    def release(self) -> None:
+        """ Drop the file records when the output files for the directory are written """
+        self.files = []
+        self.directories = []
+
     def is_media_directory(self) -> bool:
         total_files = len(self.files)
         total_media = 0
@@ -114,7 +185,7 @@ class Meta:
                 res["lg"] = thumbnail_lg
         return res
 
-    def to_dict(self) -> dict:
+    def to_dict(self, compact: bool = False) -> dict:
         result = {}
         if self.path:
             result["path"] = str(self.path or ".")
@@ -125,11 +196,88 @@ class Meta:
             result["thumbnail"] = dict(thumbnail)
         result["media"] = self.is_media_directory()
         if self.directories:
-            result["directories"] = [d.to_dict() for d in self.directories]
+            result["directories"] = [d.to_dict(compact=compact) for d in self.directories]
         if self.files:
-            result["files"] = [f.to_dict() for f in self.files]
+            result["files"] = [f.to_dict(compact=compact) for f in self.files]
         result["size"] = self.size
+        result["hash_algorithm"] = self.hash_algorithm
+        result["hash_policy"] = self.hash_policy
         return result
 
+    @staticmethod
+    def read_hash_algorithm(meta_file: Path) -> str | None:
+        """ Hash algorithm of the .meta file, it is in the tail of the file after the records """
+        try:
+            match = Meta.HASH_ALGORITHM_PATTERN.search(FileUtil.read_tail(meta_file))
+        except OSError:
+            return None
+        return match.group(1).decode("utf-8") if match else None
+
+    def dumps(self, compact: bool = False) -> str:
+        """ Content of the .meta file: pretty printed, or minified JSON with epoch timestamps """
+        if compact:
+            return json.dumps(self.to_dict(compact=True), separators=(",", ":"), cls=SWFVJsonEncoder)
+        return json.dumps(self.to_dict(), indent=2, cls=SWFVJsonEncoder)
+
     def __str__(self) -> str:
         return json.dumps(self.to_dict(), cls=SWFVJsonEncoder)
+
+class BuildManifest:
+    """ Persisted state of a source directory from the previous build: names, mtime_ns and
+    sizes of the files, and aggregated sizes of the sub-directories. If the state of the directory
+    is the same as in the manifest, the generated files for this directory are still valid.
+    """
+    def __init__(self, config_hash: str = "") -> None:
+        self.config_hash = config_hash
+        self.files: dict[str, list[int]] = {}
+        self.directories: dict[str, int] = {}
+        self.size = 0
+
+    @staticmethod
+    def get_config_hash(config: Config, assets_hash: str = "") -> str:
+        """ Hash of the configuration values (and the theme assets, pages refer to their fingerprinted names)
+        which have an effect on the generated files
+        """
+        values = [Config.APP_VERSION, config.name, config.display_name, config.theme, config.hash_algorithm,
+                  json.dumps(config.hash_policy, sort_keys=True),
+                  *sorted(f"{k}={v.value}" for k, v in config.file_types.items()),
+                  *sorted(v.value for v in config.flags),
+                  *([f"gzip={config.gzip_level}"] if config.gzip_level else []),
+                  *(["meta=compact"] if config.meta_compact else []),
+                  *(["search"] if config.search_index else []),
+                  *(["thumbnails"] if is_thumbnails_enabled(config) else []),
+                  *([f"page_size={config.page_size}"] if config.page_size != Config.DEF_PAGE_SIZE else []),
+                  *([f"symlinks={config.symlinks}"] if config.symlinks != Config.SYMLINK_MODES[0] else []),
+                  *(["one_file_system"] if config.one_file_system else []),
+                  *([f"assets={assets_hash}"] if assets_hash else [])]
+        return FileInfo.HASH.get_hash("|".join(str(v) for v in values))
+
+    @staticmethod
+    def load(path: Path) -> BuildManifest | None:
+        try:
+            with path.open("rt") as reader:
+                data = json.load(reader)
+            manifest = BuildManifest(config_hash=data.get("config", ""))
+            manifest.files = {k: list(v) for k, v in data.get("files", {}).items()}
+            manifest.directories = dict(data.get("directories", {}))
+            manifest.size = int(data.get("size", 0))
+            return manifest
+        except (OSError, ValueError, TypeError, AttributeError) as ex:
+            logger.debug(f"Can't load manifest {path}: {ex}")
+        return None
+
+    def save(self, path: Path) -> bool:
+        return FileUtil.write_if_changed(path, json.dumps(self.to_dict(), separators=(",", ":")))
+
+    def to_dict(self) -> dict:
+        return {
+            "config": self.config_hash,
+            "files": self.files,
+            "directories": self.directories,
+            "size": self.size,
+        }
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, BuildManifest):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
@@ -1,72 +1,189 @@
 """
 """
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
 import shutil
-from typing import TYPE_CHECKING
+import stat
 
-if TYPE_CHECKING:
-    from pathlib import Path
-    from swfv.config import Config
+from swfv.config import Config
+from swfv.data import BuildManifest, Meta
+from swfv.utils.common import HashUtil
+from swfv.utils.fs import FileUtil
 
-def cleanup(work_dir: Path, config: Config) -> int:     # noqa: PLR0912, PLR0915, C901
+DELETE_WORKERS = 8
+
+
+def _get_generated_names(directory: Path, config: Config) -> set[str]:
+    """ Names of the generated files in the output directory, except the pages. The checksum files are
+    of the configured algorithm and of the algorithm recorded in .meta by the previous build.
+    """
+    names = {config.meta_file, f"{config.meta_file}.gz", config.manifest_file, config.hash_file}
+    algorithm = Meta.read_hash_algorithm(directory / config.meta_file)
+    if algorithm in HashUtil.algorithms():
+        names.add(Config.get_hash_file(algorithm))
+    return names
+
+
+def _is_generated_page(path: Path) -> bool:
+    """ Check the marker in the tail of the page, the pages of the users are not deleted """
+    return FileUtil.has_tail_marker(path, Config.PAGE_MARKER)
+
+
+def _collect_from_manifest(directory: Path, manifest: BuildManifest, config: Config,
+                           result: tuple[list[Path], list[Path], list[Path]]) -> list[Path]:
+    """ Collect the generated files of the directory by their names, without listing the directory.
+    Returns the sub-directories from the manifest.
+    """
+    dirs, files, pages = result
+    for name in _get_generated_names(directory, config):
+        if os.path.lexists(directory / name):
+            files.append(directory / name)
+    if (directory / config.thumbs_dir).is_dir():
+        dirs.append(directory / config.thumbs_dir)
+    page = 1
+    while True:
+        page_path = directory / config.get_page_file(page)
+        if os.path.lexists(page_path):
+            pages.append(page_path)
+        elif os.path.lexists(page_path.with_name(f"{page_path.name}.gz")):
+            files.append(page_path.with_name(f"{page_path.name}.gz"))
+        else:
+            break
+        page += 1
+    return [directory / name for name in manifest.directories]
+
+
+def _is_real_dir(p: Path) -> bool:
+    """ Symlinks to the directories are not followed, the same as in _collect_from_scan """
+    try:
+        return stat.S_ISDIR(p.lstat().st_mode)
+    except OSError:
+        return False
+
+
+def _collect_from_scan(directory: Path, config: Config,
+                       result: tuple[list[Path], list[Path], list[Path]]) -> list[Path]:
+    """ Collect the generated files of the directory with one scan, returns the sub-directories """
+    dirs, files, pages = result
+    generated_names = _get_generated_names(directory, config)
+    sub_dirs = []
+    names = set()
+    gz_pages = []
+    for p, st in FileUtil.scan(directory, hidden=True):
+        if stat.S_ISDIR(st.st_mode):
+            if p.name == config.thumbs_dir:
+                dirs.append(p)
+            elif not p.name.startswith(".") and not stat.S_ISLNK(p.lstat().st_mode):
+                sub_dirs.append(p)
+            continue
+        names.add(p.name)
+        if p.name in generated_names:
+            files.append(p)
+        elif config.get_page_number(p.name) is not None:
+            pages.append(p)
+        elif config.is_page_file(p.name):
+            gz_pages.append(p)
+    # gzip copies are deleted with their pages, only the copies without pages are deleted here
+    files.extend(p for p in gz_pages if p.name.removesuffix(".gz") not in names)
+    return sub_dirs
+
+
+def collect_generated(work_dir: Path, config: Config) -> tuple[list[Path], list[Path], list[Path]]:
+    """ Collect the generated directories, files and pages in one walk over the output tree.
+    The directories with a build manifest are not listed, their generated files have known names
+    and the manifest has the names of the sub-directories.
+    """
+    result: tuple[list[Path], list[Path], list[Path]] = ([], [], [])
+    dirs, files, _ = result
+    for name in (config.assets_dir, config.search_dir):
+        if (work_dir / name).is_dir():
+            dirs.append(work_dir / name)
+    for name in (config.changes_file, *(Config.DEF_TREE_INDEX_FILE + v for v in Config.TREE_INDEX_FORMATS.values())):
+        if (work_dir / name).exists():
+            files.append(work_dir / name)
+    stack = [work_dir]
+    # (st_dev, st_ino) of the walked directories, bind mount loops are walked once
+    visited: set[tuple[int, int]] = set()
+    while stack:
+        directory = stack.pop()
+        try:
+            dir_stat = directory.stat()
+        except OSError:
+            continue
+        if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+            continue
+        visited.add((dir_stat.st_dev, dir_stat.st_ino))
+        manifest = BuildManifest.load(directory / config.manifest_file)
+        if manifest is not None:
+            stack.extend(p for p in _collect_from_manifest(directory, manifest, config, result) if _is_real_dir(p))
+        else:
+            stack.extend(_collect_from_scan(directory, config, result))
+    return result
+
+
+def _delete_dir(p: Path) -> str:
+    if p.is_dir() and not p.is_symlink():
+        shutil.rmtree(p)
+    else:
+        p.unlink(missing_ok=True)
+    return f"[DIR ] {p} - DELETED"
+
+
+def _delete_file(p: Path) -> str:
+    p.unlink(missing_ok=True)
+    return f"[FILE] {p} - DELETED"
+
+
+def _delete_page(p: Path) -> str:
+    need_to_delete = _is_generated_page(p)
+    if need_to_delete:
+        p.unlink(missing_ok=True)
+        p.with_name(f"{p.name}.gz").unlink(missing_ok=True)
+    return f"[FILE] {p} - DELETED ({str(need_to_delete).lower()})"
+
+
+def cleanup(work_dir: Path, config: Config) -> int:
     err_code = 0
-    print(f"Collect all directories to deletion in {work_dir}...")
-    dirs = list(work_dir.rglob(pattern=config.thumbs_dir))
-    dirs.append(work_dir / config.assets_dir)
-    print(f"Found {len(dirs)} directories.")
-    print(f"Collect all files to deletion in {work_dir}...")
-    files = list(work_dir.rglob(pattern=config.meta_file))
-    files.extend(list(work_dir.rglob(pattern=config.hash_file)))
-    files.extend(list(work_dir.rglob(pattern=config.index_file)))
-    print(f"Found {len(files)} files.")
-    if not dirs and not files:
+    print(f"Collect all generated directories and files to deletion in {work_dir}...")
+    dirs, files, pages = collect_generated(work_dir, config)
+    print(f"Found {len(dirs)} directories and {len(files) + len(pages)} files.")
+    if not dirs and not files and not pages:
         print("There are nothing do delete. Exit.")
         return 0
 
     print("Paths which will be deleted:")
     for p in dirs:
         print(f"[DIR ] {p}")
-    for p in files:
+    for p in (*files, *pages):
         print(f"[FILE] {p}")
-    print(f"There are {len(dirs)} directories and {len(files)} files will be deleted.")
+    print(f"There are {len(dirs)} directories and {len(files) + len(pages)} files will be deleted.")
     answer = (input(f"Do you really want to cleanup in '{work_dir}' (y/N)? ") or "No").lower().strip()
     if answer not in ("yes", "y"):
         print(f"Answer is '{answer}'. Exit.")
         return 1
-    for p in dirs:
-        try:
-            if not p.exists():
-                continue
-            if p.is_dir() and not p.is_symlink():
-                shutil.rmtree(p)
-            else:
-                p.unlink()
-            print(f"[DIR ] {p} - DELETED")
-        except OSError as ex:
-            err_code += 1
-            print(f"[FILE] {p} - delete failed: {ex}")
-    for p in files:
-        try:
-            if not p.exists():
-                continue
-            need_to_delete = False
-            if p.name == config.index_file:
-                check_line = "generated on"
-                with p.open("r") as reader:
-                    for line in reader.readlines():
-                        if check_line in line.lower():
-                            need_to_delete = True
-                            break
-            else:
-                need_to_delete = True
-            if need_to_delete:
-                p.unlink(missing_ok=True)
-            print(f"[FILE] {p} - DELETED ({str(need_to_delete).lower()})")
-        except OSError as ex:
-            err_code += 1
-            print(f"[FILE] {p} - delete failed: {ex}")
+    tasks = [(_delete_dir, p) for p in dirs] + [(_delete_file, p) for p in files] + [(_delete_page, p) for p in pages]
+    with ThreadPoolExecutor(max_workers=max(config.jobs, DELETE_WORKERS), thread_name_prefix="cleanup") as pool:
+        futures = [(pool.submit(func, p), p) for func, p in tasks]
+        for future, p in futures:
+            try:
+                print(future.result())
+            except OSError as ex:
+                err_code += 1
+                print(f"[{'DIR ' if p in dirs else 'FILE'}] {p} - delete failed: {ex}")
     if err_code:
         print(f"Cleanup was failed: {err_code} errors.")
     else:
         print("Cleanup was successfull")
     return err_code
+
+def cache_gc(config: Config, max_age_days: int) -> int:
+    hash_util = HashUtil(config.APP_NAME)
+    print(f"Cleanup hash cache {hash_util.cache_path} (max age: {max_age_days} days)...")
+    try:
+        deleted = hash_util.cleanup_cache(max_age_days=max_age_days)
+    finally:
+        hash_util.close()
+    print(f"Cleanup was successfull: {deleted} cache entries deleted")
+    return 0
@@ -0,0 +1,200 @@
+""" Tree-wide index of the site: one record per file and directory in a single file at the root of
+the output directory (NDJSON or sqlite3 database). Records are written while the directories are built.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from swfv.utils.fs import FileUtil
+
+if TYPE_CHECKING:
+    import sqlite3
+    from collections.abc import Iterable
+
+    from swfv.config import Config
+    from swfv.data import Meta
+
+logger = logging.getLogger()
+
+Row = tuple[str, str, bool, str, int, int, int, str | None, str | None]
+
+
+class TreeIndex:
+    """ Base class for the index writers. A build writes a new index to a temp file, which replaces
+    the index on close, the records of the unchanged directories are read from their .meta files.
+    In the update mode (updates of single directories in the watch mode) only the records of the added
+    directories are replaced.
+    """
+    COLUMNS = ("dir", "name", "file", "type", "size", "created", "modified", "hash", "mime")
+
+    def __init__(self, path: Path, update: bool = False) -> None:
+        self.path = path
+        self.update = update
+        # directory -> names of its sub-directories, for the directories added in the update mode
+        self.replaced: dict[str, set[str]] = {}
+        self.count = 0
+
+    @staticmethod
+    def create(config: Config, update: bool = False) -> TreeIndex | None:
+        if not config.tree_index:
+            return None
+        path = config.output / config.tree_index_file
+        if update and not path.exists():
+            # records of the other directories are unknown, the index is created by the full build
+            logger.info(f"Tree index {path} doesn't exist, it will be created by the next build")
+            return None
+        if config.tree_index == "sqlite":
+            return SqliteTreeIndex(path, update=update)
+        return NdjsonTreeIndex(path, update=update)
+
+    @staticmethod
+    def get_dir(path: Path | str) -> str:
+        value = Path(path).as_posix()
+        return "" if value == "." else value
+
+    @staticmethod
+    def _timestamp(value: int | str | None) -> int:
+        if isinstance(value, int):
+            return value
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()) if value else 0
+
+    def add_meta(self, meta: Meta) -> None:
+        """ Add records for the directory from Meta """
+        dir_name = TreeIndex.get_dir(meta.path)
+        rows = [(dir_name, fi.name, fi.file, fi.type.value, int(fi.size or 0), fi.created_ts, fi.modified_ts,
+                 fi.hash, fi.mime) for fi in (*meta.directories, *meta.files)]
+        self._add(dir_name, rows)
+
+    def add_meta_file(self, dir_path: Path, meta_file: Path) -> None:
+        """ Add records for the directory from its .meta file, it is used for the directories which were not changed """
+        dir_name = TreeIndex.get_dir(dir_path)
+        try:
+            with meta_file.open("rt") as reader:
+                data = json.load(reader)
+            rows = [(dir_name, item["name"], bool(item.get("file")), str(item.get("type")), int(item.get("size") or 0),
+                     TreeIndex._timestamp(item.get("created")), TreeIndex._timestamp(item.get("modified")),
+                     item.get("hash"), item.get("mime"))
+                    for item in (*data.get("directories", []), *data.get("files", []))]
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logger.warning(f"Can't read {meta_file} for the tree index: {ex}")
+            return
+        self._add(dir_name, rows)
+
+    def _add(self, dir_name: str, rows: list[Row]) -> None:
+        if self.update:
+            self.replaced[dir_name] = {row[1] for row in rows if not row[2]}
+        self.write_rows(dir_name, rows)
+        self.count += len(rows)
+
+    def is_replaced(self, dir_name: str) -> bool:
+        """ Check if the records of the old index for the directory are replaced or removed in the update mode """
+        if dir_name in self.replaced:
+            return True
+        parts = dir_name.split("/") if dir_name else []
+        for i in range(len(parts)):
+            parent = "/".join(parts[:i])
+            if parent in self.replaced and parts[i] not in self.replaced[parent]:
+                return True
+        return False
+
+    def write_rows(self, dir_name: str, rows: list[Row]) -> None:
+        raise NotImplementedError
+
+    def close(self, commit: bool = True) -> bool:
+        """ Finish the index. Returns True if the index file was written. """
+        raise NotImplementedError
+
+    def _create_temp(self, suffix: str) -> Path:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=suffix)
+        os.close(fd)
+        return Path(tmp_name)
+
+
+class NdjsonTreeIndex(TreeIndex):
+    """ One JSON object per line, the records of the old index are copied in the update mode """
+    def __init__(self, path: Path, update: bool = False) -> None:
+        super().__init__(path, update=update)
+        self.tmp_path = self._create_temp(".tmp")
+        self.writer = self.tmp_path.open("wt", encoding="utf-8")
+
+    def write_rows(self, dir_name: str, rows: list[Row]) -> None:
+        self.writer.writelines(
+            json.dumps(dict(zip(TreeIndex.COLUMNS, row)), separators=(",", ":")) + "\n" for row in rows)
+
+    def _copy_old_rows(self) -> None:
+        with self.path.open("rt", encoding="utf-8") as reader:
+            for line in reader:
+                try:
+                    dir_name = json.loads(line)["dir"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if not self.is_replaced(dir_name):
+                    self.writer.write(line)
+
+    def close(self, commit: bool = True) -> bool:
+        try:
+            if commit and self.update:
+                self._copy_old_rows()
+            self.writer.close()
+            if commit:
+                FileUtil.replace_file(self.tmp_path, self.path)
+                logger.info(f"Tree index: {self.path} ({self.count} records written)")
+                return True
+            return False
+        finally:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+class SqliteTreeIndex(TreeIndex):
+    """ Table 'entries' with an index by the directory, the records are updated in place in the update mode """
+    def __init__(self, path: Path, update: bool = False) -> None:
+        super().__init__(path, update=update)
+        import sqlite3  # optional index format
+        self.tmp_path: Path | None = None
+        self.db: sqlite3.Connection
+        if self.update:
+            self.db = sqlite3.connect(self.path)
+        else:
+            self.tmp_path = self._create_temp(".db")
+            self.db = sqlite3.connect(self.tmp_path)
+            # the temp database is discarded on errors, there is nothing to recover
+            self.db.execute("PRAGMA journal_mode=OFF")
+            self.db.execute("PRAGMA synchronous=OFF")
+            self.db.execute("CREATE TABLE entries (dir TEXT NOT NULL, name TEXT NOT NULL, file INTEGER NOT NULL, "
+                            "type TEXT, size INTEGER, created INTEGER, modified INTEGER, hash TEXT, mime TEXT)")
+
+    def _delete_dir(self, dir_name: str, sub_dirs: Iterable[str]) -> None:
+        removed = [name for (name,) in self.db.execute(
+            "SELECT name FROM entries WHERE dir = ? AND file = 0", (dir_name,)) if name not in sub_dirs]
+        self.db.execute("DELETE FROM entries WHERE dir = ?", (dir_name,))
+        for name in removed:
+            removed_dir = f"{dir_name}/{name}" if dir_name else name
+            pattern = removed_dir.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+            self.db.execute("DELETE FROM entries WHERE dir = ? OR dir LIKE ? ESCAPE '\\'", (removed_dir, pattern))
+
+    def write_rows(self, dir_name: str, rows: list[Row]) -> None:
+        if self.update:
+            self._delete_dir(dir_name, self.replaced[dir_name])
+        self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self, commit: bool = True) -> bool:
+        try:
+            if commit:
+                self.db.execute("CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir)")
+                self.db.commit()
+            self.db.close()
+            if commit and self.tmp_path:
+                FileUtil.replace_file(self.tmp_path, self.path)
+            if commit:
+                logger.info(f"Tree index: {self.path} ({self.count} records written)")
+            return commit
+        finally:
+            if self.tmp_path:
+                self.tmp_path.unlink(missing_ok=True)
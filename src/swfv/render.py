@@ -0,0 +1,189 @@
+""" Renderer of the built-in default theme without Jinja: pages are written straight from the Meta records
+with string joins. The output is the same as page.j2 of the default theme renders, so the renderer is used
+only if page.j2 of the theme is the template it was written for (TEMPLATE_HASH). Other themes and changed
+templates are rendered by Jinja. `python -m swfv.bench --check-render` compares the output of both renderers.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING
+
+from swfv.thumbs import has_thumbnail
+from swfv.utils.fs import FileType, FileUtil
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+    from swfv.config import Config
+    from swfv.data import FileInfo, Meta
+
+logger = logging.getLogger()
+
+TEMPLATE_NAME = "page.j2"
+
+
+def escape(value: object) -> str:
+    """ HTML escaping of Jinja autoescape (markupsafe.escape) """
+    return (str(value).replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+            .replace("'", "&#39;").replace('"', "&#34;"))
+
+
+class DefaultPageRenderer:
+    # sha256 of page.j2 of the default theme, update it together with the render methods
+    TEMPLATE_HASH = "7711c75931dffb9bd4dc2319fdaa92358a78768190c807136cd9534cba916610"
+
+    def __init__(self, config: Config, asset_url: Callable[[str], str]) -> None:
+        self.config = config
+        self.asset_url = asset_url
+        # escaped URLs of the assets and icons (by the depth of the directory), they are the same for all pages
+        self._assets: dict[str, str] = {}
+        self._icons: dict[tuple[int, str], str] = {}
+
+    @staticmethod
+    def supports(theme_path: Path) -> bool:
+        """ Check if page.j2 of the theme is the template which the renderer writes """
+        try:
+            content = (theme_path / TEMPLATE_NAME).read_bytes()
+        except OSError:
+            return False
+        return hashlib.sha256(content).hexdigest() == DefaultPageRenderer.TEMPLATE_HASH
+
+    def asset(self, name: str) -> str:
+        if name not in self._assets:
+            self._assets[name] = escape(self.asset_url(name))
+        return self._assets[name]
+
+    def icon(self, depth: int, name: str) -> str:
+        key = (depth, name)
+        if key not in self._icons:
+            self._icons[key] = escape(f"{'../' * depth}{self.asset_url(f'icons/{name}')}")
+        return self._icons[key]
+
+    def render(self, context: dict, meta: Meta, page_files: list[FileInfo]) -> str:
+        """ Render the page with the values of the page.j2 context, the items are created from page_files """
+        relpath = escape(context["relpath"])
+        page, page_count = context["page"], context["page_count"]
+        out = [self._render_head(context, relpath)]
+        if not self.config.flag_show_title:
+            out.append(f'<h1><a href="{relpath}" title="Go to the root">{escape(context["display_name"])}</a></h1>')
+        out.append(f'\n    <h2>Index of {escape(context["path"])}')
+        if page_count > 1:
+            out.append(f" (page {escape(page)} of {escape(page_count)})")
+        out.append("</h2>")
+        if self.config.search_index:
+            out.append('\n    <div class="search">\n'
+                       '        <input id="search" type="search" placeholder="Search files and directories"'
+                       ' autocomplete="off"\n'
+                       f'               data-root="{relpath}" data-index="{escape(self.config.search_dir)}"/>\n'
+                       '        <ul id="searchResults" class="search-results"></ul>\n'
+                       "    </div>")
+        out.append('\n    <table class="files">\n'
+                   "        <thead>\n"
+                   "        <tr>\n"
+                   "            <th>Name</th>\n"
+                   "            <th>Size</th>\n"
+                   "            <th>&nbsp;</th>\n"
+                   '            <th class="hide-on-mobile">Modified</th>\n'
+                   "        </tr>\n"
+                   "        </thead>\n"
+                   "        <tbody>")
+        self._render_items(out, meta, page_files, relpath)
+        out.append("</tbody>\n    </table>")
+        if page_count > 1:
+            out.append('\n    <nav class="pages">')
+            for link in context["page_links"]:
+                if not link["number"]:
+                    out.append("\n        <span>&hellip;</span>")
+                elif link["current"]:
+                    out.append(f'\n        <span class="current">{escape(link["number"])}</span>')
+                else:
+                    out.append(f'\n        <a href="{escape(link["path"])}">{escape(link["number"])}</a>')
+            out.append("\n    </nav>")
+        out.append(self._render_footer(context))
+        return "".join(out)
+
+    def _render_head(self, context: dict, relpath: str) -> str:
+        return ("<html>\n"
+                "<head>\n"
+                f"    <title>{escape(context['title'])}</title>\n"
+                '    <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />\n'
+                '    <meta name="viewport" content="width=device-width,initial-scale=1.0">\n'
+                f'    <meta name="apple-mobile-web-app-title" content="{escape(context["name"])}" />\n'
+                f'    <link rel="icon" type="image/png" href="{relpath}{self.asset("favicon-96x96.png")}"'
+                ' sizes="96x96" />\n'
+                f'    <link rel="icon" type="image/svg+xml" href="{relpath}{self.asset("favicon.svg")}" />\n'
+                f'    <link rel="shortcut icon" href="{relpath}{self.asset("favicon.ico")}" />\n'
+                '    <link rel="apple-touch-icon" sizes="180x180"'
+                f' href="{relpath}{self.asset("apple-touch-icon.png")}" />\n'
+                f'    <link rel="manifest" href="{relpath}{self.asset("site.webmanifest")}" />\n'
+                f'    <link rel="stylesheet" href="{relpath}{self.asset("css/site.css")}">\n'
+                f'    <script src="{relpath}{self.asset("js/site.js")}"></script>\n'
+                "</head>\n"
+                '<body class="light-mode" onload="onload();">\n'
+                "<content>\n"
+                "    ")
+
+    def _render_items(self, out: list[str], meta: Meta, page_files: list[FileInfo], relpath: str) -> None:
+        """ Rows of the table, the values are the same as PageItem.from_file_info creates """
+        download = f"{relpath}{self.asset('icons/download.png')}"
+        if meta.depth > 0:
+            out.append(self._render_row(name="..", path="..", path_orig="", icon=self.icon(meta.depth, "back.png"),
+                                        size="-", type_="go back", modified="-", thumbnail="", download=""))
+        thumbnail_dir = escape(meta.thumbnail_dir)
+        for fi in page_files:
+            name = escape(fi.name)
+            path = f"./{name}" if fi.type != FileType.LINK else escape(FileUtil.read_url_file(fi.path_real))
+            thumbnail = ""
+            if meta.has_thumbnails and has_thumbnail(fi):
+                thumbnail = f"./{thumbnail_dir}/{escape(fi.thumbnail_md)}"
+            # type values and timestamps don't need escaping
+            out.append(self._render_row(
+                name=name, path=path, path_orig=name, icon=self.icon(meta.depth, fi.thumbnail_sm),
+                size=escape(FileUtil.size_format(fi.size)), type_=fi.type.value.lower(),
+                modified=fi.modified.isoformat(sep=" ")[:19], thumbnail=thumbnail,
+                download=download if fi.type != FileType.DIRECTORY else ""))
+
+    @staticmethod
+    def _render_row(name: str, path: str, path_orig: str, icon: str, size: str, type_: str,
+                    modified: str, thumbnail: str, download: str) -> str:
+        """ Row of the item with the escaped values, the download link is shown for files only """
+        if thumbnail:
+            image = (f'<img src="{thumbnail}" class="thumbnail" loading="lazy" title="{type_}"'
+                     f" onerror=\"this.onerror=null;this.className='icon';this.src='{icon}'\"/>")
+        else:
+            image = f'<img src="{icon}" class="icon" title="{type_}"/>'
+        action = "&nbsp;"
+        if download:
+            action = (f'\n                <a href="./{path_orig}" class="icon" target="_blank">'
+                      f'<img src="{download}" class="icon" title="Download {name}"/>')
+        return ("\n            <tr>\n"
+                f'                <td class="name"><a href="{path}" class="icon">{image}{name}</a></td>\n'
+                f'                <td class="size">{size}<a href="./{path}" class="icon"></td>\n'
+                f'                <td class="action">{action}</td>\n'
+                f'                <td class="hide-on-mobile modified">{modified}</td>\n'
+                "            </tr>\n"
+                "        ")
+
+    def _render_footer(self, context: dict) -> str:
+        hide_generated_by = self.config.flag_hide_generated_by
+        generated_by = ""
+        if not hide_generated_by:
+            app_name = escape(context["app_name"])
+            generated_by = (f'Generated by <a href="https://github.com/revgen/{app_name}">'
+                            f'{app_name} v{escape(context["app_version"])}</a>\n        ')
+        return ("\n</content>\n"
+                "<footer>\n"
+                "    \n"
+                '    <div class="left">\n'
+                f"        ID: {escape(context['page_id'])}\n"
+                f"        {'' if hide_generated_by else '<br/>'}\n"
+                f"        {generated_by}</div>\n"
+                '    <div class="right">\n'
+                '        <label id="toggleSwitchContainer" class="switch"></label>\n'
+                "    </div>\n"
+                "</footer>\n"
+                "</body>\n"
+                "</html>\n"
+                f"<!-- generated on {escape(context['datetime_iso'])} -->")
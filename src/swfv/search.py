@@ -0,0 +1,200 @@
+""" Client-side search index: names of the files and directories split into small JSON shards
+by the prefix of the words in the names. The search box of the page loads only the shard for the query.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import re
+import shutil
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from swfv.data import BuildManifest
+from swfv.utils.fs import FileUtil
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from swfv.config import Config
+
+logger = logging.getLogger()
+
+
+class SearchIndex:
+    """ Shard <hex of the prefix>.json is {"<directory>": ["<name>", "<sub-directory>/", ...]} with the entries
+    which have a word starting with the prefix. index.json has the list of the shards, site.js uses the same
+    rules to split names into words.
+    A full build writes all shards to a temp directory, which replaces the index on finish.
+    An update rewrites only the shards with the entries of the changed directories.
+    """
+    VERSION = 1
+    PREFIX_LENGTH = 2
+    INDEX_FILE = "index.json"
+    # number of the buffered records, they are appended to the temp files of the shards when it is exceeded
+    FLUSH_SIZE = 200_000
+    WORD_SPLIT = re.compile(r"[\W_]+")
+
+    def __init__(self, config: Config, update: bool = False) -> None:
+        self.config = config
+        self.path = config.output / config.search_dir
+        # the previous names of the changed directories are taken from the build manifests
+        self.update = update and (self.path / SearchIndex.INDEX_FILE).exists() and \
+            (config.output / config.manifest_file).exists()
+        # full build: prefix -> (directory, names) records, update: directory -> (old names, new names)
+        self.records: dict[str, list[tuple[str, list[str]]]] = defaultdict(list)
+        self.buffered = 0
+        self.changes: dict[str, tuple[list[str], list[str]]] = {}
+        self.tmp_path: Path | None = None
+        if not self.update:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.tmp_path = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=f"{config.search_dir}."))
+
+    @staticmethod
+    def get_prefixes(name: str) -> set[str]:
+        """ Prefixes of the words of the name, site.js searches only by the words of PREFIX_LENGTH or longer """
+        return {w[:SearchIndex.PREFIX_LENGTH] for w in SearchIndex.WORD_SPLIT.split(name.lower())
+                if len(w) >= SearchIndex.PREFIX_LENGTH}
+
+    @staticmethod
+    def get_shard_name(prefix: str) -> str:
+        return f"{prefix.encode('utf-8').hex()}.json"
+
+    @staticmethod
+    def get_names(manifest: BuildManifest | None) -> list[str]:
+        if manifest is None:
+            return []
+        return sorted([*(f"{v}/" for v in manifest.directories), *manifest.files])
+
+    def add(self, dir_path: Path, manifest: BuildManifest, prev_manifest: BuildManifest | None) -> None:
+        """ Add the entries of the directory, the previous manifest has the entries from the index """
+        dir_name = "" if dir_path.as_posix() == "." else dir_path.as_posix()
+        names = SearchIndex.get_names(manifest)
+        if not self.update:
+            for prefix, prefix_names in self._group(names).items():
+                self.records[prefix].append((dir_name, prefix_names))
+                self.buffered += len(prefix_names)
+            if self.buffered >= SearchIndex.FLUSH_SIZE:
+                self._flush()
+            return
+        old_names = SearchIndex.get_names(prev_manifest)
+        if old_names == names:
+            return
+        self.changes[dir_name] = (old_names, names)
+        output_dir = self.config.output / dir_path
+        for name in set(old_names) - set(names):
+            if name.endswith("/"):
+                self._remove_tree(output_dir / name[:-1], f"{dir_name}/{name[:-1]}".lstrip("/"))
+
+    def _remove_tree(self, output_dir: Path, dir_name: str) -> None:
+        """ Remove the entries of the deleted directory, their names are taken from the build manifests """
+        manifest = BuildManifest.load(output_dir / self.config.manifest_file)
+        names = SearchIndex.get_names(manifest)
+        self.changes[dir_name] = (names, [])
+        for name in names:
+            if name.endswith("/"):
+                self._remove_tree(output_dir / name[:-1], f"{dir_name}/{name[:-1]}")
+
+    @staticmethod
+    def _group(names: Iterable[str]) -> dict[str, list[str]]:
+        groups: dict[str, list[str]] = defaultdict(list)
+        for name in names:
+            for prefix in SearchIndex.get_prefixes(name):
+                groups[prefix].append(name)
+        return groups
+
+    def _flush(self) -> None:
+        """ Append the buffered records to the temp files of the shards """
+        if self.tmp_path is None:
+            return
+        for prefix, records in self.records.items():
+            with (self.tmp_path / f"{SearchIndex.get_shard_name(prefix)}.part").open("at", encoding="utf-8") as writer:
+                writer.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        self.records.clear()
+        self.buffered = 0
+
+    def _write_shard(self, path: Path, shard: dict[str, list[str]]) -> bool:
+        return FileUtil.write_if_changed(path, json.dumps(shard, separators=(",", ":"), sort_keys=True))
+
+    def _write_index(self, path: Path, prefixes: Iterable[str]) -> bool:
+        return FileUtil.write_if_changed(path / SearchIndex.INDEX_FILE, json.dumps({
+            "version": SearchIndex.VERSION,
+            "prefix_length": SearchIndex.PREFIX_LENGTH,
+            "shards": sorted(prefixes),
+        }, separators=(",", ":"), ensure_ascii=False))
+
+    def _finish_build(self) -> list[Path]:
+        self._flush()
+        tmp_path = self.tmp_path
+        if tmp_path is None:
+            return []
+        prefixes = []
+        for part_file in tmp_path.glob("*.json.part"):
+            shard: dict[str, list[str]] = {}
+            with part_file.open("rt", encoding="utf-8") as reader:
+                for line in reader:
+                    dir_name, names = json.loads(line)
+                    shard[dir_name] = names
+            self._write_shard(part_file.with_suffix(""), shard)
+            part_file.unlink()
+            prefixes.append(bytes.fromhex(part_file.name.split(".", 1)[0]).decode("utf-8"))
+        self._write_index(tmp_path, prefixes)
+        old_path = None
+        if self.path.exists():
+            old_path = self.path.with_name(f"{tmp_path.name}.old")
+            self.path.rename(old_path)
+        FileUtil.set_default_mode(tmp_path)
+        tmp_path.rename(self.path)
+        self.tmp_path = None
+        if old_path:
+            shutil.rmtree(old_path, ignore_errors=True)
+        logger.info(f"Search index: {self.path} ({len(prefixes)} shards)")
+        return [self.path / SearchIndex.INDEX_FILE, *(self.path / SearchIndex.get_shard_name(p) for p in prefixes)]
+
+    def _finish_update(self) -> list[Path]:
+        affected: dict[str, set[str]] = defaultdict(set)
+        for dir_name, (old_names, names) in self.changes.items():
+            for name in (*old_names, *names):
+                for prefix in SearchIndex.get_prefixes(name):
+                    affected[prefix].add(dir_name)
+        if not affected:
+            return []
+        with (self.path / SearchIndex.INDEX_FILE).open("rt", encoding="utf-8") as reader:
+            prefixes = set(json.load(reader).get("shards", []))
+        changed = []
+        for prefix, dir_names in affected.items():
+            shard_path = self.path / SearchIndex.get_shard_name(prefix)
+            shard: dict[str, list[str]] = {}
+            if prefix in prefixes:
+                with shard_path.open("rt", encoding="utf-8") as reader:
+                    shard = json.load(reader)
+            for dir_name in dir_names:
+                names = [v for v in self.changes[dir_name][1] if prefix in SearchIndex.get_prefixes(v)]
+                if names:
+                    shard[dir_name] = names
+                else:
+                    shard.pop(dir_name, None)
+            if shard:
+                prefixes.add(prefix)
+                if self._write_shard(shard_path, shard):
+                    changed.append(shard_path)
+            elif prefix in prefixes:
+                prefixes.discard(prefix)
+                shard_path.unlink(missing_ok=True)
+        if self._write_index(self.path, prefixes):
+            changed.append(self.path / SearchIndex.INDEX_FILE)
+        logger.info(f"Search index: {len(changed)} files updated for {len(self.changes)} directories")
+        return changed
+
+    def close(self, commit: bool = True) -> list[Path]:
+        """ Finish the index, returns the written files """
+        try:
+            if commit:
+                return self._finish_update() if self.update else self._finish_build()
+            return []
+        finally:
+            if self.tmp_path:
+                shutil.rmtree(self.tmp_path, ignore_errors=True)
+                self.tmp_path = None
@@ -0,0 +1,447 @@
+""" HTTP server for the generated site: a pool of threads with keep-alive connections,
+zero-copy file transfer with os.sendfile, byte ranges, ETags and conditional requests.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import quote, unquote, urlsplit
+
+from swfv.config import Config
+from swfv.utils.common import HashMode, HashUtil
+from swfv.utils.fs import FileUtil
+
+if TYPE_CHECKING:
+    import socket
+
+    from swfv.builder import PageBuilder
+    from swfv.data import Meta
+
+logger = logging.getLogger()
+
+
+class HashIndex:
+    """ Hashes of the files from the .meta files, they are used as ETags.
+    A hash is used only if the size and modification time of the file are the same as in .meta.
+    """
+    def __init__(self, meta_file: str = Config.DEF_META_FILE, max_size: int = 1024) -> None:
+        self.meta_file = meta_file
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._dirs: OrderedDict[Path, tuple[int, dict[str, tuple[int, str, str]]]] = OrderedDict()
+
+    def _load(self, directory: Path) -> dict[str, tuple[int, str, str]]:
+        meta_path = directory / self.meta_file
+        try:
+            mtime = meta_path.stat().st_mtime_ns
+        except OSError:
+            return {}
+        with self._lock:
+            cached = self._dirs.get(directory)
+            if cached and cached[0] == mtime:
+                self._dirs.move_to_end(directory)
+                return cached[1]
+        files: dict[str, tuple[int, str, str]] = {}
+        try:
+            with meta_path.open("rt") as reader:
+                for item in json.load(reader).get("files", []):
+                    if item.get("hash"):
+                        files[item["name"]] = (int(item.get("size", -1)), str(item.get("modified")), item["hash"])
+        except (OSError, ValueError, AttributeError) as ex:
+            logger.debug(f"Can't read hashes from {meta_path}: {ex}")
+        with self._lock:
+            self._dirs[directory] = (mtime, files)
+            self._dirs.move_to_end(directory)
+            while len(self._dirs) > self.max_size:
+                self._dirs.popitem(last=False)
+        return files
+
+    def get_hash(self, path: Path, stat: os.stat_result) -> str | None:
+        item = self._load(path.parent).get(path.name)
+        if not item:
+            return None
+        size, modified, hash_val = item
+        if modified.isdigit():
+            # compact .meta has epoch timestamps
+            file_modified = str(int(stat.st_mtime))
+        else:
+            file_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc).isoformat(sep="T")[:19]
+        return hash_val if size == stat.st_size and modified == file_modified else None
+
+
+class FileRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # idle keep-alive connections are closed after the timeout
+    timeout = 30
+    # headers and body are separate writes, with Nagle's algorithm the body waits for the delayed ACK
+    disable_nagle_algorithm = True
+    hash_index: HashIndex
+    index_file = Config.DEF_INDEX_FILE
+    RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+    # fingerprinted theme assets (css/site.3f2a9c1d.css) are never changed, browsers can cache them forever
+    FINGERPRINT_PATTERN = re.compile(rf"^/{Config.DEF_ASSETS_DIR}/.+\.[0-9a-f]{{{Config.ASSETS_FINGERPRINT_LENGTH}}}(\.[^./]+)?$")
+    IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def _serve(self, send_body: bool) -> None:
+        path = Path(self.translate_path(self.path))
+        if path.is_dir() and self.path.split("?", 1)[0].endswith("/") and (path / self.index_file).is_file():
+            path = path / self.index_file
+        if not path.is_file():
+            # redirects and directory listings are handled by the base class
+            f = self.send_head()
+            if f:
+                try:
+                    if send_body:
+                        self.copyfile(f, self.wfile)
+                finally:
+                    f.close()
+            return
+        try:
+            f = path.open("rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        with f:
+            self._send_file(f, path, os.fstat(f.fileno()), send_body)
+
+    def _get_etag(self, path: Path, stat: os.stat_result) -> str:
+        hash_val = self.hash_index.get_hash(path, stat)
+        if hash_val:
+            return f'"{hash_val}"'
+        return f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def _is_not_modified(self, etag: str, stat: os.stat_result) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [v.strip().removeprefix("W/") for v in if_none_match.split(",")]
+            return "*" in tags or etag.removeprefix("W/") in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+        return False
+
+    def _get_range(self, etag: str, size: int) -> tuple[int, int] | None:
+        """ Get the requested byte range (start, end inclusive), only single ranges are supported """
+        range_header = self.headers.get("Range")
+        if not range_header:
+            return None
+        if_range = (self.headers.get("If-Range") or "").strip()
+        # strong comparison (RFC 9110): weak validators never match, the full content is sent
+        if if_range and (if_range.startswith("W/") or etag.startswith("W/") or if_range != etag):
+            return None
+        match = FileRequestHandler.RANGE_PATTERN.match(range_header.strip())
+        if not match or not any(match.groups()):
+            return None
+        start, end = match.groups()
+        if not start:
+            # suffix range: the last N bytes
+            return max(0, size - int(end)), size - 1
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+    def _send_content(self, content: bytes, content_type: str, etag: str, stat: os.stat_result,
+                      send_body: bool) -> None:
+        if self._is_not_modified(etag, stat):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content)
+
+    def _send_file(self, f: object, path: Path, stat: os.stat_result, send_body: bool) -> None:
+        size = stat.st_size
+        etag = self._get_etag(path, stat)
+        if self._is_not_modified(etag, stat):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        byte_range = self._get_range(etag, size)
+        if byte_range and (byte_range[0] >= size or byte_range[0] > byte_range[1]):
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        length = max(0, end - start + 1)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        if FileRequestHandler.FINGERPRINT_PATTERN.match(urlsplit(self.path).path):
+            self.send_header("Cache-Control", FileRequestHandler.IMMUTABLE_CACHE_CONTROL)
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if send_body and length:
+            self.wfile.flush()
+            # socket.sendfile uses os.sendfile (zero-copy) if it is available
+            self.connection.sendfile(f, offset=start, count=length)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+@dataclass
+class Listing:
+    """ Cached listing of the directory, Meta is kept only if the directory has more than one page """
+    key: tuple[int, int]
+    meta_content: bytes
+    page_hash: str
+    page_count: int
+    pages: dict[int, bytes] = field(default_factory=dict)
+    meta: Meta | None = None
+
+
+class ListingCache:
+    """ LRU cache of the rendered pages and .meta content of the directories.
+    An entry is valid while the modification time and the number of entries of the directory are the same.
+    """
+    def __init__(self, config: Config, builder: PageBuilder, max_size: int = 1024) -> None:
+        self.config = config
+        self.builder = builder
+        self.max_size = max_size
+        self.hash_util = HashUtil(config.APP_NAME, algorithm=config.hash_algorithm, use_mmap=config.hash_mmap)
+        self._lock = threading.Lock()
+        self._items: OrderedDict[Path, Listing] = OrderedDict()
+        # lazy hashes are calculated one by one in the background, the requests don't wait for them
+        self.hash_pool: ThreadPoolExecutor | None = None
+        self._hashing: set[Path] = set()
+        if config.hash_mode == HashMode.LAZY:
+            self.hash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lazy-hash")
+
+    @staticmethod
+    def get_key(directory: Path, stat: os.stat_result) -> tuple[int, int]:
+        with os.scandir(directory) as entries:
+            return stat.st_mtime_ns, sum(1 for _ in entries)
+
+    def get(self, directory: Path, stat: os.stat_result) -> Listing:
+        """ Get the listing of the directory, the directory is scanned only if it was changed """
+        key = ListingCache.get_key(directory, stat)
+        with self._lock:
+            item = self._items.get(directory)
+            if item and item.key == key:
+                self._items.move_to_end(directory)
+                return item
+        from swfv.core import scan_meta  # only the dynamic mode builds pages
+        source = self.config.source.absolute()
+        meta = scan_meta(directory, self.config, self.hash_util, depth=len(directory.relative_to(source).parts))
+        logger.info(f"Render page for {directory}: {len(meta.directories)} directories, {len(meta.files)} files")
+        page_count = self.builder.get_page_count(meta)
+        item = Listing(key=key, meta_content=meta.dumps(compact=self.config.meta_compact).encode("utf-8"),
+                       page_hash=self.builder.get_page_hash(meta), page_count=page_count,
+                       meta=meta if page_count > 1 else None)
+        item.pages[1] = self.builder.render_page(meta, page_hash=item.page_hash).encode("utf-8")
+        with self._lock:
+            self._items[directory] = item
+            self._items.move_to_end(directory)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return item
+
+    def get_lazy_hash(self, path: Path, stat: os.stat_result) -> str | None:
+        """ Get the known full hash of the file in the lazy mode. If the hash is unknown, the file is hashed
+        in the background and the hash is used by the next requests and builds.
+        """
+        if self.hash_pool is None:
+            return None
+        mode = self.config.get_hash_mode(stat.st_size, requested=True, file_type=lambda: FileUtil.get_file_type(
+            path, path.suffix[1:].lower(), FileUtil.get_mime_type(path.name)))
+        if mode != HashMode.FULL:
+            return None
+        hash_val = self.hash_util.get_hash_from_file(path, stat=stat, mode=HashMode.LAZY)
+        if hash_val is None:
+            with self._lock:
+                if path in self._hashing:
+                    return None
+                self._hashing.add(path)
+            self.hash_pool.submit(self._calculate_hash, path)
+        return hash_val
+
+    def _calculate_hash(self, path: Path) -> None:
+        try:
+            self.hash_util.get_hash_from_file(path)
+            self.hash_util.flush()
+        except OSError as ex:
+            logger.debug(f"Can't calculate hash of {path}: {ex}")
+        finally:
+            with self._lock:
+                self._hashing.discard(path)
+
+    def close(self) -> None:
+        if self.hash_pool:
+            self.hash_pool.shutdown(cancel_futures=True)
+        self.hash_util.close()
+
+    def get_page(self, item: Listing, page: int) -> bytes | None:
+        """ Get the page of the listing, pages after the first one are rendered on the first request """
+        content = item.pages.get(page)
+        if content is None and item.meta and 1 <= page <= item.page_count:
+            content = self.builder.render_page(item.meta, page=page, page_hash=item.page_hash).encode("utf-8")
+            with self._lock:
+                item.pages[page] = content
+        return content
+
+
+class DynamicRequestHandler(FileRequestHandler):
+    """ Serves the source directory without generated files: pages and .meta of the directories
+    are rendered on demand, theme assets are served from the theme directory.
+    """
+    listing_cache: ListingCache
+
+    def _get_etag(self, path: Path, stat: os.stat_result) -> str:
+        hash_val = self.listing_cache.get_lazy_hash(path, stat)
+        if hash_val:
+            return f'"{hash_val}"'
+        return super()._get_etag(path, stat)
+
+    def translate_path(self, path: str) -> str:
+        config = self.listing_cache.config
+        parts = [p for p in unquote(urlsplit(path).path).split("/") if p]
+        if parts and parts[0] == config.assets_dir:
+            # the base class resolves the path safely, it is moved to the assets of the theme
+            rel_path = Path(super().translate_path("/" + quote("/".join(parts[1:])))).relative_to(self.directory)
+            # fingerprinted names of the pages are mapped to the theme files
+            rel_path = Path(self.listing_cache.builder.get_asset_source(rel_path.as_posix()) or rel_path)
+            return str(self.listing_cache.builder.theme_path.absolute() / config.assets_dir / rel_path)
+        return super().translate_path(path)
+
+    def _serve(self, send_body: bool) -> None:
+        config = self.listing_cache.config
+        path = Path(self.translate_path(self.path))
+        url_path = urlsplit(self.path).path
+        page = config.get_page_number(path.name)
+        generated = page is not None or path.name == config.meta_file
+        directory = path.parent if generated else path
+        source = Path(self.directory)
+        if not directory.is_dir() or (not generated and not url_path.endswith("/")) or \
+                (directory != source and source not in directory.parents):
+            super()._serve(send_body)
+            return
+        stat = directory.stat()
+        listing = self.listing_cache.get(directory, stat)
+        etag = f'W/"{listing.key[0]:x}-{listing.key[1]:x}"'
+        if path.name == config.meta_file:
+            self._send_content(listing.meta_content, "application/json", etag, stat, send_body)
+            return
+        content = self.listing_cache.get_page(listing, page or 1)
+        if content is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "Page not found")
+            return
+        self._send_content(content, "text/html; charset=utf-8", etag, stat, send_body)
+
+
+class PooledHTTPServer(HTTPServer):
+    """ HTTP server which handles connections in a pool of threads, the number of connections is limited """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], handler: type[FileRequestHandler],
+                 max_connections: int = 64) -> None:
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="http")
+        self.connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request: socket.socket, client_address: tuple[str, int]) -> None:
+        if not self.connections.acquire(blocking=False):
+            logger.warning(f"Too many connections, reject {client_address}")
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request: socket.socket, client_address: tuple[str, int]) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:                                   # noqa: BLE001
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.connections.release()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(webroot: Path, host: str = "localhost", port: int = 8080, max_connections: int = 64,
+          meta_file: str = Config.DEF_META_FILE, index_file: str = Config.DEF_INDEX_FILE) -> int:
+    webroot = webroot.absolute()
+    handler = type("Handler", (FileRequestHandler,), {"hash_index": HashIndex(meta_file=meta_file),
+                                                      "index_file": index_file})
+    handler_factory = _bind_directory(handler, webroot)
+    print(f"Working directory:{webroot} ")
+    line_length = 80
+    print("*" * line_length)
+    print("*", "!!! WARNING !!!".center(line_length - 4), "*")
+    print("*", f"Web server was started: http://{host}:{port}".center(line_length - 4), "*")
+    print("*" * line_length)
+    with PooledHTTPServer((host, port), handler_factory, max_connections=max_connections) as httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def serve_dynamic(config: Config, host: str = "localhost", port: int = 8080, max_connections: int = 64,
+                  cache_size: int = 1024) -> int:
+    """ Serve the source directory, pages are rendered on demand without writing files """
+    from swfv.builder import PageBuilder  # only the dynamic mode builds pages
+    # scan_meta takes the paths of the directories relative to the source, the requested paths are absolute
+    config.source = config.source.absolute()
+    webroot = config.source
+    FileUtil.register_file_types(config.file_types)
+    cache = ListingCache(config, PageBuilder(config=config), max_size=cache_size)
+    handler = type("Handler", (DynamicRequestHandler,), {"hash_index": HashIndex(), "listing_cache": cache,
+                                                         "index_file": config.index_file})
+    print(f"Source directory:{webroot} ")
+    print(f"Web server was started in the dynamic mode: http://{host}:{port}")
+    with PooledHTTPServer((host, port), _bind_directory(handler, webroot), max_connections=max_connections) as httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cache.close()
+    return 0
+
+
+def _bind_directory(handler: type[FileRequestHandler], directory: Path) -> type[FileRequestHandler]:
+    class DirectoryHandler(handler):
+        def __init__(self, *args: object, **kwargs: object) -> None:
+            super().__init__(*args, directory=str(directory), **kwargs)
+    return DirectoryHandler
+
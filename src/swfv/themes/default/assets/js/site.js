@@ -4,6 +4,7 @@ function onload() {
     console.debug(`Read mode from the storage: darkModeCheckBox=${checked}`);
     switchLabel.innerHTML = `<input id="toggleSwitch" type="checkbox" ${checked} onclick="toggleMode();"><span class="slider round"></span>`;
     toggleMode(!!checked);
+    setupSearch();
 };
 
 function toggleMode(darkMode) {
@@ -30,3 +31,76 @@ function toggleMode(darkMode) {
         localStorage.setItem("mode", "light");
     }
 };
+
+const SEARCH_LIMIT = 100;
+const search = {root: "", dir: "", cache: new Map(), timer: null, seq: 0};
+
+function setupSearch() {
+    const input = document.getElementById("search");
+    if (!input) {
+        return;
+    }
+    search.root = input.dataset.root;
+    search.dir = input.dataset.index;
+    input.addEventListener("input", () => {
+        clearTimeout(search.timer);
+        search.timer = setTimeout(() => runSearch(input.value), 50);
+    });
+};
+
+function splitWords(value) {
+    // the same rule as in the search index builder
+    return value.toLowerCase().split(/[^\p{L}\p{N}]+/u).filter(w => w);
+};
+
+function shardName(prefix) {
+    const bytes = Array.from(new TextEncoder().encode(prefix), b => b.toString(16).padStart(2, "0"));
+    return `${bytes.join("")}.json`;
+};
+
+function fetchSearchFile(name) {
+    // the shards are loaded only once, only for the typed queries
+    if (!search.cache.has(name)) {
+        const url = `${search.root}${search.dir}/${name}`;
+        search.cache.set(name, fetch(url).then(r => r.ok ? r.json() : null).catch(() => null));
+    }
+    return search.cache.get(name);
+};
+
+async function runSearch(query) {
+    const seq = ++search.seq;
+    const results = document.getElementById("searchResults");
+    const words = splitWords(query);
+    const index = await fetchSearchFile("index.json");
+    const key = words.reduce((a, b) => b.length > a.length ? b : a, "");
+    if (!index || key.length < index.prefix_length) {
+        results.replaceChildren();
+        return;
+    }
+    const prefix = key.slice(0, index.prefix_length);
+    const shard = index.shards.includes(prefix) ? await fetchSearchFile(shardName(prefix)) : null;
+    if (seq !== search.seq) {
+        return;
+    }
+    const found = [];
+    for (const [dir, names] of Object.entries(shard || {})) {
+        for (const name of names) {
+            const nameWords = splitWords(name);
+            if (words.every(w => nameWords.some(nw => nw.startsWith(w)))) {
+                found.push(dir ? `${dir}/${name}` : name);
+            }
+        }
+        if (found.length >= SEARCH_LIMIT) {
+            break;
+        }
+    }
+    console.debug(`Search '${query}': ${found.length} results in the shard '${prefix}'`);
+    results.replaceChildren(...found.sort().slice(0, SEARCH_LIMIT).map(path => {
+        const item = document.createElement("li");
+        const link = document.createElement("a");
+        link.href = search.root + path.split("/").map(encodeURIComponent).join("/");
+        link.textContent = path;
+        item.appendChild(link);
+        return item;
+    }));
+};
@@ -0,0 +1,149 @@
+""" Thumbnails of the images: <thumbs_dir>/<name>.md.jpg and <name>.lg.jpg in the output directories.
+They are created with Pillow, if it is installed, in a pool of processes. Created thumbnails are cached
+by the content hash of the image, so unchanged images are never processed again.
+"""
+from __future__ import annotations
+
+import filecmp
+import importlib.util
+import logging
+import os
+import shutil
+from functools import cache
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from swfv.utils.common import HashUtil
+from swfv.utils.fs import FileType, FileUtil
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    from swfv.config import Config
+    from swfv.data import FileInfo, Meta
+
+logger = logging.getLogger()
+
+# max width and height of the thumbnails
+THUMBNAIL_SIZES = {"md": 320, "lg": 1280}
+# Pillow can't read vector images
+SKIP_MIME_TYPES = ("image/svg+xml",)
+
+
+@cache
+def is_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def is_enabled(config: Config) -> bool:
+    return config.thumbnails and is_available()
+
+
+def has_thumbnail(file_info: FileInfo) -> bool:
+    return file_info.type == FileType.IMAGE and file_info.mime not in SKIP_MIME_TYPES
+
+
+def _create_thumbnails(src: Path, targets: list[tuple[Path, int]]) -> bool:
+    """ Create thumbnails of the image with the max sizes, it runs in the worker processes """
+    from PIL import Image, ImageOps  # optional dependency
+    try:
+        with Image.open(src) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            # the largest thumbnail first, the smaller ones are made from it
+            for target, size in sorted(targets, key=lambda v: v[1], reverse=True):
+                image.thumbnail((size, size))
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+                image.save(tmp_path, "JPEG", quality=85, optimize=True)
+                os.replace(tmp_path, target)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as ex:
+        logger.warning(f"Can't create thumbnails for {src}: {ex}")
+        return False
+
+
+class ThumbnailStage:
+    """ Schedules thumbnails for the directories, finish() copies them from the cache to the output directories
+    and removes thumbnails of the images which were deleted.
+    """
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.hash_util = HashUtil(config.APP_NAME)
+        self.cache_dir = self.hash_util.cache_dir / "thumbs"
+        self.pool: ProcessPoolExecutor | None = None
+        self.pending: dict[str, Future] = {}
+        # (cache file, output file) pairs and (thumbs directory, expected names) of the scheduled directories
+        self.copies: list[tuple[Path, Path]] = []
+        self.cleanups: list[tuple[Path, set[str]]] = []
+
+    def get_cache_path(self, key: str, size_name: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.{size_name}.jpg"
+
+    def add(self, meta: Meta, output_dir: Path) -> bool:
+        """ Schedule thumbnails for the images of the directory, returns True if the directory has them """
+        thumbs_dir = output_dir / self.config.thumbs_dir
+        expected: set[str] = set()
+        for fi in meta.files:
+            if not has_thumbnail(fi):
+                continue
+            key = self.hash_util.get_hash(fi.page_hash)
+            names = {"md": fi.thumbnail_md, "lg": fi.thumbnail_lg}
+            missing = [(self.get_cache_path(key, n), THUMBNAIL_SIZES[n]) for n in names
+                       if not self.get_cache_path(key, n).exists()]
+            if missing and key not in self.pending:
+                self.pending[key] = self._get_pool().submit(_create_thumbnails, fi.path_real, missing)
+            for size_name, name in names.items():
+                self.copies.append((self.get_cache_path(key, size_name), thumbs_dir / name))
+                expected.add(name)
+        self.cleanups.append((thumbs_dir, expected))
+        return bool(expected)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # multiprocessing is slow to import
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(max_workers=self.config.jobs, mp_context=multiprocessing.get_context("spawn"))
+        return self.pool
+
+    def finish(self) -> list[Path]:
+        """ Wait for the thumbnails and copy them to the output directories, returns the changed files """
+        for future in self.pending.values():
+            future.result()
+        self.pending.clear()
+        changed: list[Path] = []
+        for cache_path, output_path in self.copies:
+            if not cache_path.exists():
+                continue
+            if output_path.exists() and filecmp.cmp(cache_path, output_path, shallow=False):
+                continue
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cache_path, output_path)
+            FileUtil.set_default_mode(output_path)
+            changed.append(output_path)
+        self.copies.clear()
+        for thumbs_dir, expected in self.cleanups:
+            self._cleanup(thumbs_dir, expected)
+        self.cleanups.clear()
+        if changed:
+            logger.info(f"Thumbnails: {len(changed)} files written")
+        return changed
+
+    def _cleanup(self, thumbs_dir: Path, expected: set[str]) -> None:
+        """ Remove thumbnails of the deleted images, and the directory if it is empty """
+        if not thumbs_dir.is_dir():
+            return
+        for p, _ in FileUtil.scan(thumbs_dir, hidden=True):
+            if p.name not in expected:
+                logger.info(f"Remove thumbnail: {p}")
+                p.unlink(missing_ok=True)
+        if not expected:
+            thumbs_dir.rmdir()
+
+    def close(self) -> None:
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        self.hash_util.close()
@@ -1,15 +1,27 @@
 """ The module contains common utils, such as:
 * BaseJsonEncoder
+* HashMode
 * HashUtil
 """
 from __future__ import annotations
 import hashlib
 import json
 import logging
+import mmap
+import shutil
+import threading
+import time
 
 from datetime import datetime, timezone
+from enum import Enum
 from pathlib import Path, PurePath
-from typing import Union
+from typing import TYPE_CHECKING, Union
+
+from swfv.utils.stats import STATS
+
+if TYPE_CHECKING:
+    import os
+    import sqlite3
 
 logger = logging.getLogger()
 
@@ -25,30 +37,236 @@ class BaseJsonEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+class HashMode(Enum):
+    NONE = "none"
+    # only the known (cached) full hashes are used, files are hashed when they are requested
+    LAZY = "lazy"
+    SAMPLED = "sampled"
+    FULL = "full"
+
+    @staticmethod
+    def parse(value: str | HashMode | None) -> HashMode:
+        if isinstance(value, HashMode):
+            return value
+        mode_name = str(value or HashMode.FULL.value).strip().upper()
+        if not hasattr(HashMode, mode_name):
+            raise ValueError(f"Can't find '{value}' in the hash modes: {HashMode.values()}")
+        return HashMode[mode_name]
+
+    @staticmethod
+    def values() -> list[str]:
+        return [mode.value for mode in HashMode]
+
+
 class HashUtil:
-    def __init__(self, app_name: str) -> None:
-        self.cache_path = Path.home() / ".cache" / app_name / "hashes"
-
-    def get_hash_from_file(self, file: Path) -> str:
-        logger.debug(f"Calculate hash for {file}")
-        file_stat = file.stat()
-        output_file = f"{file.stem}-{int(file_stat.st_size)}-{int(file_stat.st_mtime)}"
-        output_file = self.get_hash(output_file)
-        output_dir = self.cache_path / output_file[:2]
-        output_dir.mkdir(parents=True, exist_ok=True)
-        cache_file = output_dir / output_file
-        if cache_file.exists():
-            logger.debug(f"Found hash in the cache: {cache_file}")
-            hash_val = cache_file.read_text()
+    """ Calculates hashes of the files and keeps them in the sqlite cache.
+    A cached hash is valid while the file has the same device, inode, size and mtime_ns.
+    Hashes of the hard linked files are kept in memory by the inode, other links of the file are not read again.
+    """
+    DEF_ALGORITHM = "md5"
+    DEF_CHUNK_SIZE = 1024 * 1024
+    SAMPLE_SIZE = 64 * 1024
+    CACHE_FLUSH_SIZE = 1000
+
+    def __init__(self, app_name: str, algorithm: str = DEF_ALGORITHM,
+                 chunk_size: int = DEF_CHUNK_SIZE, use_mmap: bool = False) -> None:
+        self.cache_dir = Path.home() / ".cache" / app_name
+        self.cache_path = self.cache_dir / "hashes.db"
+        self.algorithm = HashUtil.parse_algorithm(algorithm)
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.RLock()
+        self._prefetched: dict[str, dict[str, tuple[int, int, int, int, str]]] = {}
+        self._pending: list[tuple] = []
+        self._seen: list[tuple] = []
+        # (dev, ino, size, mtime_ns, algorithm) -> hash of the files with several hard links
+        self._inodes: dict[tuple[int, int, int, int, str], str] = {}
+
+    @staticmethod
+    def algorithms() -> list[str]:
+        # shake_* algorithms need a digest length, they are not suitable here
+        return sorted(v for v in hashlib.algorithms_guaranteed if not v.startswith("shake_"))
+
+    @staticmethod
+    def parse_algorithm(value: str | None) -> str:
+        algorithm = (value or HashUtil.DEF_ALGORITHM).strip().lower().replace("-", "_")
+        if algorithm not in HashUtil.algorithms():
+            raise ValueError(f"Can't find '{value}' in the hash algorithms: {HashUtil.algorithms()}")
+        return algorithm
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            logger.debug(f"Open hash cache: {self.cache_path}")
+            import sqlite3  # not needed by all commands
+            self._db = sqlite3.connect(self.cache_path, timeout=60, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT NOT NULL, algorithm TEXT NOT NULL, dir TEXT NOT NULL,
+                dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL, seen INTEGER NOT NULL,
+                PRIMARY KEY (path, algorithm))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS hashes_dir ON hashes (dir, algorithm)")
+            self._db.commit()
+        return self._db
+
+    def prefetch(self, directory: Path) -> int:
+        """ Load cached hashes for all files in the directory with one query """
+        dir_path = str(directory.absolute())
+        started = STATS.start()
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT path, algorithm, dev, ino, size, mtime_ns, hash FROM hashes "
+                "WHERE dir = ? AND algorithm IN (?, ?)",
+                (dir_path, self.algorithm, self._get_cache_algorithm(HashMode.SAMPLED))).fetchall()
+            self._prefetched[dir_path] = {(path, algorithm): tuple(values) for path, algorithm, *values in rows}
+        STATS.stop("hash_cache", started, prefetches=1, prefetched=len(rows))
+        logger.debug("Found %d hashes in the cache for %s", len(rows), directory)
+        return len(rows)
+
+    def forget(self, directory: Path) -> None:
+        """ Release hashes loaded by prefetch() for the directory """
+        with self._lock:
+            self._prefetched.pop(str(directory.absolute()), None)
+
+    def _get_cache_algorithm(self, mode: HashMode) -> str:
+        return self.algorithm if mode in (HashMode.FULL, HashMode.LAZY) else f"{self.algorithm}:{mode.value}"
+
+    def _find_cached(self, path: Path, algorithm: str) -> tuple[int, int, int, int, str] | None:
+        with self._lock:
+            prefetched = self._prefetched.get(str(path.parent))
+            if prefetched is not None:
+                return prefetched.get((str(path), algorithm))
+            row = self.db.execute(
+                "SELECT dev, ino, size, mtime_ns, hash FROM hashes WHERE path = ? AND algorithm = ?",
+                (str(path), algorithm)).fetchone()
+        return tuple(row) if row else None
+
+    def get_hash_from_file(self, file: Path, stat: os.stat_result | None = None,
+                           mode: HashMode = HashMode.FULL) -> str | None:
+        if mode == HashMode.NONE:
+            return None
+        file_stat = stat or file.stat()
+        file_path = file.absolute()
+        algorithm = self._get_cache_algorithm(mode)
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        started = STATS.start()
+        cached = self._find_cached(file_path, algorithm)
+        STATS.stop("hash_cache", started, lookups=1)
+        now = int(time.time())
+        if cached and cached[:4] == key:
+            logger.debug("Found hash in the cache: %s", file)
+            hash_val = cached[4]
+            STATS.count("hash", cache_hits=1)
+            with self._lock:
+                self._seen.append((now, str(file_path), algorithm))
         else:
-            hash_val = self.get_hash(file.read_bytes())
-            logger.debug(f"Calculate hash and store in the cache: {cache_file}")
-            cache_file.write_text(hash_val)
-        logger.debug(f"Hash was calculated ({hash_val}): {file}")
+            linked_hash = self._inodes.get((*key, algorithm)) if file_stat.st_nlink > 1 else None
+            if linked_hash is not None:
+                logger.debug("Found hash of the hard link: %s", file)
+                hash_val = linked_hash
+                STATS.count("hash", inode_hits=1)
+            elif mode == HashMode.LAZY:
+                STATS.count("hash", lazy_misses=1)
+                return None
+            else:
+                started = STATS.start()
+                if mode == HashMode.SAMPLED:
+                    hash_val = self.calculate_sampled_hash_from_file(file, size=file_stat.st_size)
+                    size = min(file_stat.st_size, HashUtil.SAMPLE_SIZE * 3)
+                else:
+                    hash_val = self.calculate_hash_from_file(file)
+                    size = file_stat.st_size
+                STATS.stop("hash", started, cache_misses=1, files=1, bytes=size)
+                logger.debug("Calculate hash (mode=%s) and store in the cache: %s", mode.value, file)
+            with self._lock:
+                self._pending.append((str(file_path), algorithm, str(file_path.parent), *key, hash_val, now))
+        if file_stat.st_nlink > 1 and hash_val:
+            with self._lock:
+                self._inodes[(*key, algorithm)] = hash_val
+        if len(self._pending) + len(self._seen) >= HashUtil.CACHE_FLUSH_SIZE:
+            self.flush()
         return hash_val
 
+    def flush(self) -> None:
+        """ Store all new hashes in the cache """
+        with self._lock:
+            if not self._pending and not self._seen:
+                return
+            started = STATS.start()
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    self._pending)
+                self.db.executemany("UPDATE hashes SET seen = ? WHERE path = ? AND algorithm = ?", self._seen)
+            STATS.stop("hash_cache", started, flushes=1, flushed=len(self._pending) + len(self._seen))
+            self._pending.clear()
+            self._seen.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self.flush()
+                self._db.close()
+                self._db = None
+            self._prefetched.clear()
+            self._inodes.clear()
+
+    def cleanup_cache(self, max_age_days: int) -> int:
+        """ Delete hashes of the files which don't exist anymore or weren't seen for max_age_days """
+        with self._lock:
+            self.flush()
+            min_seen = int(time.time()) - max_age_days * 24 * 60 * 60
+            total_changes = self.db.total_changes
+            with self.db:
+                self.db.execute("DELETE FROM hashes WHERE seen < ?", (min_seen,))
+                missing = [(path,) for (path,) in self.db.execute("SELECT DISTINCT path FROM hashes")
+                           if not Path(path).is_file()]
+                self.db.executemany("DELETE FROM hashes WHERE path = ?", missing)
+            deleted = self.db.total_changes - total_changes
+            self.db.execute("VACUUM")
+        legacy_cache_dir = self.cache_dir / "hashes"
+        if legacy_cache_dir.is_dir():
+            logger.info(f"Delete legacy hash cache: {legacy_cache_dir}")
+            shutil.rmtree(legacy_cache_dir, ignore_errors=True)
+        return deleted
+
+    def calculate_hash_from_file(self, file: Path) -> str:
+        """ Calculate hash of the file content, the file is read by chunks with a constant memory usage """
+        hash_obj = hashlib.new(self.algorithm)
+        with file.open("rb") as reader:
+            if self.use_mmap and file.stat().st_size > 0:
+                with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                        memoryview(data) as view:
+                    for pos in range(0, len(view), self.chunk_size):
+                        hash_obj.update(view[pos:pos + self.chunk_size])
+            else:
+                buffer = bytearray(self.chunk_size)
+                view = memoryview(buffer)
+                while size := reader.readinto(buffer):
+                    hash_obj.update(view[:size])
+        return hash_obj.hexdigest().lower()
+
+    def calculate_sampled_hash_from_file(self, file: Path, size: int) -> str:
+        """ Calculate hash of the file size and the head, middle and tail blocks of the file.
+        It is not a checksum of the content, but it is enough to detect changes of large files.
+        """
+        hash_obj = hashlib.new(self.algorithm)
+        hash_obj.update(str(size).encode("utf-8"))
+        block = HashUtil.SAMPLE_SIZE
+        with file.open("rb") as reader:
+            if size <= block * 3:
+                hash_obj.update(reader.read())
+            else:
+                for pos in (0, size // 2 - block // 2, size - block):
+                    reader.seek(pos)
+                    hash_obj.update(reader.read(block))
+        return hash_obj.hexdigest().lower()
+
     def get_hash(self, data: Union[str, bytes]) -> str:
-        md5 = hashlib.md5()                                         # noqa: S324
+        hash_obj = hashlib.new(self.algorithm)
         data4hash = data if isinstance(data, bytes) else str(data).encode("utf-8")
-        md5.update(data4hash)
-        return md5.hexdigest().lower()
+        hash_obj.update(data4hash)
+        return hash_obj.hexdigest().lower()
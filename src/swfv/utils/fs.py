@@ -1,17 +1,29 @@
 from __future__ import annotations
+import filecmp
+import gzip
 import logging
 import math
+import mimetypes
+import os
+import posixpath
 import shutil
+import stat
+import tempfile
 from enum import Enum
 from pathlib import Path
-from typing import Union, TYPE_CHECKING
+from typing import BinaryIO, ClassVar, Union, TYPE_CHECKING
 import urllib
 
+from swfv.utils.stats import STATS
+
 if TYPE_CHECKING:
-    from collections.abc import Generator
+    from collections.abc import Callable, Generator
 
 logger = logging.getLogger()
 
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 class FileType(Enum):
     DIRECTORY = "directory"
@@ -41,8 +53,8 @@ class FileType(Enum):
                 res = value
             else:
                 value_name = value.upper().strip()
-            if hasattr(FileType, value_name):
-                res = getattr(FileType, value_name)
+                if hasattr(FileType, value_name):
+                    res = getattr(FileType, value_name)
         logger.debug(f"FileType.Parse({value}) -> {res}")
         return res
 
@@ -63,17 +75,236 @@ class FileUtil:
     FILE_TYPES_CONFIG = ("yaml", "yml", "config", "cfg", "conf", "properties", "toml", "tml")
     FILE_TYPES_LINK = ("url", "link")
 
+    _custom_types: ClassVar[dict[str, FileType]] = {}
+    _mime_cache: ClassVar[dict[str, str]] = {}
+    _subtype_cache: ClassVar[dict[str, tuple[int, FileType] | None]] = {}
+    _type_cache: ClassVar[dict[tuple[str, str], tuple[FileType, bool]]] = {}
+
     @staticmethod
     def search(path: Path, pattern: str = "*", hidden: bool = False) -> Generator[Path, None, None]:
         return (p1 for p1 in path.glob(pattern=pattern) if hidden or not p1.name.startswith("."))
 
     @staticmethod
-    def copy(src: Path, dest: Path) -> None:
+    def scan(path: Path, hidden: bool = False, symlinks: bool = True) -> Generator[tuple[Path, os.stat_result],
+                                                                                   None, None]:
+        """ List the directory with os.scandir, only one stat call is made for each entry.
+        Use stat.S_ISDIR(st_mode) to check for directories, the result follows symlinks as Path.is_dir() does.
+        Symlinks are skipped with symlinks=False.
+        """
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if (not hidden and entry.name.startswith(".")) or (not symlinks and entry.is_symlink()):
+                    continue
+                try:
+                    yield Path(entry.path), entry.stat()
+                except OSError as ex:
+                    logger.warning(f"Can't stat {entry.path}: {ex}")
+
+    @staticmethod
+    def walk(path: Path, hidden: bool = False, visited: set[tuple[int, int]] | None = None) -> Generator[
+            tuple[Path, list[tuple[Path, os.stat_result]], list[tuple[Path, os.stat_result]]], None, None]:
+        """ Walk the directory tree top-down like os.walk, but yields the stat results with the paths.
+        Directories are walked once by (st_dev, st_ino), so symlink loops and bind mounts are not walked again.
+        """
+        if visited is None:
+            root_stat = path.stat()
+            visited = {(root_stat.st_dev, root_stat.st_ino)}
+        dirs: list[tuple[Path, os.stat_result]] = []
+        files: list[tuple[Path, os.stat_result]] = []
+        for p, st in FileUtil.scan(path, hidden=hidden):
+            (dirs if stat.S_ISDIR(st.st_mode) else files).append((p, st))
+        yield path, dirs, files
+        for p, st in dirs:
+            if (st.st_dev, st.st_ino) not in visited:
+                visited.add((st.st_dev, st.st_ino))
+                yield from FileUtil.walk(p, hidden=hidden, visited=visited)
+
+    @staticmethod
+    def copy(src: Path, dest: Path) -> list[Path]:
+        """ Copy the directory tree, only new and changed files are copied. Returns the copied files. """
         logger.debug(f"Copying {src} -> {dest}")
-        shutil.copytree(str(src.absolute()), str(dest.absolute()), dirs_exist_ok=True)
+        changed: list[Path] = []
+        for src_dir, _, files in FileUtil.walk(src, hidden=True):
+            dest_dir = dest / src_dir.relative_to(src)
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            for p, _ in files:
+                dest_file = dest_dir / p.name
+                if dest_file.exists() and filecmp.cmp(p, dest_file, shallow=False):
+                    continue
+                shutil.copy2(p, dest_file)
+                changed.append(dest_file)
+        return changed
+
+    @staticmethod
+    def copy_file(src: Path, dest: Path, hardlink: bool = False) -> None:
+        """ Copy the file atomically (temp file and rename). With hardlink=True the file is linked, if both paths
+        are on the same filesystem. Otherwise copy_file_range is used (the data is copied in the kernel),
+        if it is available.
+        """
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            if hardlink:
+                try:
+                    os.link(src, tmp_path)
+                    FileUtil.replace_file(tmp_path, dest)
+                    return
+                except OSError as ex:
+                    logger.debug("Can't link %s, copy it: %s", src, ex)
+            with src.open("rb") as reader, tmp_path.open("wb") as writer:
+                FileUtil._copy_content(reader, writer)
+            FileUtil.set_default_mode(tmp_path)
+            FileUtil.replace_file(tmp_path, dest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _copy_content(reader: BinaryIO, writer: BinaryIO) -> None:
+        if hasattr(os, "copy_file_range"):
+            try:
+                left = os.fstat(reader.fileno()).st_size
+                while left > 0:
+                    copied = os.copy_file_range(reader.fileno(), writer.fileno(), left)
+                    if copied == 0:
+                        break
+                    left -= copied
+                return
+            except OSError as ex:
+                # not supported by the filesystems, copy in the user space
+                logger.debug("copy_file_range failed: %s", ex)
+                reader.seek(0)
+                writer.seek(0)
+                writer.truncate()
+        shutil.copyfileobj(reader, writer)
 
     @staticmethod
-    def get_file_type(path: Path, ext: str, mime: str) -> FileType:         # noqa: PLR0912, C901
+    def write_if_changed(path: Path, content: Union[str, bytes],
+                         normalize: Callable[[bytes], bytes] | None = None) -> bool:
+        """ Write the file atomically (temp file and rename), if the content is different from the existing file.
+        The normalize function can remove volatile parts (e.g. generation time) from the content before comparing.
+        Returns True if the file was written.
+        """
+        started = STATS.start()
+        data = content.encode("utf-8") if isinstance(content, str) else content
+        try:
+            old_data = path.read_bytes()
+            if old_data == data or (normalize and normalize(old_data) == normalize(data)):
+                logger.debug("File was not changed: %s", path)
+                STATS.stop("write", started, files=1, unchanged=1)
+                return False
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as writer:
+                writer.write(data)
+            FileUtil.replace_file(Path(tmp_name), path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        STATS.stop("write", started, files=1, bytes=len(data))
+        return True
+
+    @staticmethod
+    def replace_file(tmp_path: Path, path: Path) -> None:
+        """ Move the temp file to the path atomically """
+        FileUtil.set_default_mode(tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def set_default_mode(path: Path) -> None:
+        """ mkstemp and mkdtemp create paths with 0600/0700, generated files should have the default permissions """
+        os.chmod(path, (0o777 if path.is_dir() else 0o666) & ~_UMASK)
+
+    @staticmethod
+    def write_gzip(path: Path, level: int) -> bool:
+        """ Write the gzip compressed copy of the file (<name>.gz), if it is older than the file.
+        Returns True if the compressed file was written.
+        """
+        gz_path = path.with_name(f"{path.name}.gz")
+        try:
+            src_mtime = path.stat().st_mtime_ns
+            if gz_path.stat().st_mtime_ns >= src_mtime:
+                return False
+        except FileNotFoundError:
+            if not path.exists():
+                return False
+        # mtime=0 makes the output the same for the same content
+        started = STATS.start()
+        data = gzip.compress(path.read_bytes(), compresslevel=level, mtime=0)
+        STATS.stop("gzip", started, files=1, bytes=len(data))
+        changed = FileUtil.write_if_changed(gz_path, data)
+        if not changed:
+            # the file was rewritten with the same content, mark the compressed copy as up to date
+            os.utime(gz_path)
+        return changed
+
+    @staticmethod
+    def get_mime_type(name: str) -> str:
+        """ Cached mimetypes.guess_type, the result depends only on the last two extensions of the name """
+        base, ext = posixpath.splitext(name)
+        key = posixpath.splitext(base)[1] + ext
+        mime = FileUtil._mime_cache.get(key)
+        if mime is None:
+            mime = FileUtil._mime_cache[key] = (mimetypes.guess_type(f"file{key}")[0] or "").lower()
+        return mime
+
+    @staticmethod
+    def register_file_types(file_types: dict[str, Union[str, FileType]]) -> None:
+        """ Add custom extensions to the classification table: {"ipynb": "code", "log": "text"} """
+        for ext, file_type in (file_types or {}).items():
+            FileUtil._custom_types[ext.strip().lower().lstrip(".")] = FileType.parse(file_type)
+        FileUtil._type_cache.clear()
+
+    @staticmethod
+    def _get_subtype_rule(mime_subtype: str) -> tuple[int, FileType] | None:
+        """ Find the last rule (with the highest priority) matched by the mime subtype """
+        res = FileUtil._subtype_cache.get(mime_subtype, ())
+        if res == ():
+            res = None
+            for priority, file_type, subtypes, patterns in _FILE_TYPE_RULES:
+                if mime_subtype in subtypes or any(v in mime_subtype for v in patterns):
+                    res = (priority, file_type)
+            FileUtil._subtype_cache[mime_subtype] = res
+        return res
+
+    @staticmethod
+    def get_file_type(path: Path, ext: str, mime: str) -> FileType:
+        key = (mime, ext)
+        cached = FileUtil._type_cache.get(key)
+        if cached is None:
+            cached = FileUtil._type_cache[key] = FileUtil._classify(ext, mime)
+        file_type, check_name = cached
+        if check_name:
+            # rules for the file name have the highest priority
+            if "Dockerfile" in path.name:
+                file_type = FileType.CODE
+            elif path.name.startswith("env."):
+                file_type = FileType.CONFIG
+        logger.debug(f"Get file type: {path} / {ext} / {mime} -> {file_type}")
+        return file_type
+
+    @staticmethod
+    def _classify(ext: str, mime: str) -> tuple[FileType, bool]:
+        """ Get the file type by the extension and mime type, and a flag to check the rules for the file name """
+        if ext in FileUtil._custom_types:
+            return FileUtil._custom_types[ext], False
+        mime_type, _, mime_subtype = mime.partition("/")
+        mime_type = mime_type.lower().strip()
+        if mime_type in ("audio", "image", "video"):
+            return FileType.parse(mime_type), False
+        if mime_type and mime_type not in ("application", "text"):
+            return FileType.FILE, False
+        mime_subtype = mime_subtype.split("/")[0].lower().strip().replace("x-", "").replace("vnd.", "")
+        matched = [v for v in (FileUtil._get_subtype_rule(mime_subtype), _FILE_TYPE_EXT_RULES.get(ext)) if v]
+        return (max(matched, key=lambda v: v[0])[1] if matched else FileType.FILE), True
+
+    @staticmethod
+    def get_file_type_by_rules(path: Path, ext: str, mime: str) -> FileType:   # noqa: PLR0912, C901
+        """ Reference implementation of get_file_type with the sequential rules, the last matched rule wins.
+        get_file_type gives the same results using the precomputed tables.
+        """
         mime_parts = (mime + "/").split("/")
         mime_type = mime_parts[0].lower().strip()
         logger.debug(f"Get file type: {path} / {ext} / {mime_type}")
@@ -124,6 +355,19 @@ class FileUtil:
         # TODO: replace non ASCII to ASCII
         return (file_name or "").replace(" ", "_")
 
+    @staticmethod
+    def size_parse(value: Union[str, int, None]) -> int:
+        """ Parse size values like 512, 100K, 20MB, 1G to bytes """
+        text = str(value or "0").strip().upper().removesuffix("B")
+        units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024, "T": 1024 * 1024 * 1024 * 1024}
+        multiplier = units.get(text[-1:], 1)
+        if text[-1:] in units:
+            text = text[:-1]
+        try:
+            return int(float(text) * multiplier)
+        except ValueError:
+            raise ValueError(f"Can't parse size value '{value}'") from None
+
     @staticmethod
     def size_format(size_val: int, round: bool = False) -> str:     # noqa: A002
         val = int(size_val) if size_val > 0 else 0
@@ -142,6 +386,22 @@ class FileUtil:
           return f"{math.ceil(res_val)}{res_unit}"
         return f"{res_val:0.2f}{res_unit}"
 
+    @staticmethod
+    def read_tail(path: Path, tail_size: int = 4096) -> bytes:
+        """ Read the last tail_size bytes of the file """
+        with path.open("rb") as reader:
+            size = reader.seek(0, os.SEEK_END)
+            reader.seek(max(0, size - tail_size))
+            return reader.read()
+
+    @staticmethod
+    def has_tail_marker(path: Path, marker: bytes, tail_size: int = 4096) -> bool:
+        """ Check if the tail of the file contains the marker (case insensitive) """
+        try:
+            return marker in FileUtil.read_tail(path, tail_size=tail_size).lower()
+        except OSError:
+            return False
+
     @staticmethod
     def read_url_file(path: Path) -> str:
         file_size = path.stat().st_size
@@ -160,6 +420,32 @@ class FileUtil:
 
 
 
+# Rules for application/*, text/* and unknown mime types, the last matched rule wins:
+# (file type, mime subtypes, mime subtype patterns, extensions)
+_FILE_TYPE_RULES_SRC = (
+    (FileType.DOCUMENT, ("rtf", "visio", "abiword"), ("opendocument", "document"), ()),
+    (FileType.PRESENTATION, (), ("presentation", "powerpoint"), ()),
+    (FileType.SPREADSHEET, (), ("spreadsheet", "excel"), ()),
+    (FileType.COMPRESSED, ("zip", "gzip", "bzip2", "tar", "rar", "7z", "xz"), ("compressed",), ()),
+    (FileType.DATA, ("json",), ("+json",), ()),
+    (FileType.DATA, ("xml", "xaml"), ("+xml",), ("xml", "xslt", "xhtml")),
+    (FileType.PDF, ("pdf",), (), ()),
+    (FileType.PDF, (), (), ("djv", "djvu")),
+    (FileType.EBOOK, FileUtil.FILE_TYPES_EBOOK, ("ebook",), FileUtil.FILE_TYPES_EBOOK),
+    (FileType.LINK, FileUtil.FILE_TYPES_LINK, (), FileUtil.FILE_TYPES_LINK),
+    (FileType.CODE, FileUtil.FILE_TYPES_CODE, (), FileUtil.FILE_TYPES_CODE),
+    (FileType.TEXT, FileUtil.FILE_TYPES_TEXT, (), FileUtil.FILE_TYPES_TEXT),
+    (FileType.SCRIPT, FileUtil.FILE_TYPES_SHELL, (), FileUtil.FILE_TYPES_SHELL),
+    (FileType.CONFIG, FileUtil.FILE_TYPES_CONFIG, (), FileUtil.FILE_TYPES_CONFIG),
+)
+_FILE_TYPE_RULES = tuple((priority, file_type, frozenset(subtypes), patterns)
+                         for priority, (file_type, subtypes, patterns, _) in enumerate(_FILE_TYPE_RULES_SRC))
+_FILE_TYPE_EXT_RULES: dict[str, tuple[int, FileType]] = {
+    ext: (priority, file_type)
+    for priority, (file_type, _, _, exts) in enumerate(_FILE_TYPE_RULES_SRC) for ext in exts
+}
+
+
 def download(uri: str, output: Path) -> None:
     try:
         output_path = Path(output)
@@ -0,0 +1,106 @@
+""" The module contains build statistics utils, such as:
+* BuildStats - timers and counters of the build phases (--stats)
+* Progress - periodic progress log lines with the throughput and ETA
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+logger = logging.getLogger()
+
+
+class BuildStats:
+    """ Timers and counters by the build phase. It is disabled by default: start() returns 0
+    and stop() returns at once, so the instrumented code has almost no overhead without --stats.
+    Worker processes send their values to the main process with take() and merge().
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.phases: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> float:
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stop(self, phase: str, started: float, **counters: float) -> None:
+        """ Add the time since start() and the counters to the phase """
+        if self.enabled:
+            self._add(phase, {"seconds": time.perf_counter() - started, **counters})
+
+    def count(self, phase: str, **counters: float) -> None:
+        if self.enabled:
+            self._add(phase, counters)
+
+    def _add(self, phase: str, counters: dict[str, float]) -> None:
+        with self._lock:
+            values = self.phases.setdefault(phase, {})
+            for k, v in counters.items():
+                values[k] = values.get(k, 0) + v
+
+    def take(self) -> dict[str, dict[str, float]]:
+        """ Return the collected values and reset them """
+        with self._lock:
+            phases, self.phases = self.phases, {}
+        return phases
+
+    def merge(self, phases: dict[str, dict[str, float]]) -> None:
+        for phase, counters in phases.items():
+            self._add(phase, counters)
+
+    def report(self, total_seconds: float) -> dict:
+        """ JSON report: the values of the phases and their rates per second """
+        phases = {}
+        for phase, values in sorted(self.phases.items()):
+            seconds = values.get("seconds", 0)
+            item: dict[str, float] = {k: round(v, 4) if isinstance(v, float) else v for k, v in sorted(values.items())}
+            if seconds > 0:
+                item.update({f"{k}_per_sec": round(v / seconds, 1 if k != "bytes" else None)
+                             for k, v in values.items() if k in ("files", "bytes", "pages", "dirs")})
+            phases[phase] = item
+        return {"total_seconds": round(total_seconds, 4), "phases": phases}
+
+
+STATS = BuildStats()
+
+
+class Progress:
+    """ Logs the number of the processed directories and files with the throughput and ETA,
+    not more often than every interval seconds. ETA is estimated by the directories found so far.
+    """
+    def __init__(self, interval: float = 5.0) -> None:
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last = self.started
+        self.dirs_found = 1
+        self.dirs_done = 0
+        self.files = 0
+        self.bytes = 0
+
+    def found(self, count: int) -> None:
+        self.dirs_found += count
+
+    def done(self, files: int, size: int) -> None:
+        self.dirs_done += 1
+        self.files += files
+        self.bytes += size
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            logger.info(self.format(now))
+
+    def format(self, now: float, final: bool = False) -> str:
+        from swfv.utils.fs import FileUtil  # fs imports this module
+        elapsed = max(now - self.started, 1e-6)
+        line = (f"{self.dirs_done} directories, {self.files} files "
+                f"({self.files / elapsed:.0f} files/s, {FileUtil.size_format(int(self.bytes / elapsed))}/s)")
+        if final:
+            return f"Processed {line} in {timedelta(seconds=int(elapsed))}"
+        left = max(0, self.dirs_found - self.dirs_done)
+        eta = timedelta(seconds=int(left * elapsed / self.dirs_done)) if self.dirs_done else "unknown"
+        return f"Progress: {line}, {left} directories left, ETA {eta}"
+
+    def finish(self) -> None:
+        logger.info(self.format(time.monotonic(), final=True))
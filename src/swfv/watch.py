@@ -0,0 +1,199 @@
+""" Watch mode: keep the generated site up to date with the source directory.
+Changes are received from inotify (Linux) or by polling modification times of the directories.
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from swfv.builder import PageBuilder
+from swfv.core import BuildPipeline, process_dir, update_dirs
+from swfv.utils.fs import FileUtil
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+    from swfv.config import Config
+
+logger = logging.getLogger()
+
+
+class Watcher:
+    """ Base class for the watchers, changes() yields sets of the changed source directories.
+    None is yielded if the changes were lost and the whole tree must be checked.
+    """
+    def __init__(self, config: Config, delay: float) -> None:
+        self.config = config
+        self.source = config.source.absolute()
+        self.delay = delay
+
+    def is_ignored(self, name: str) -> bool:
+        """ Hidden and generated files (including temp files of atomic writes) are not watched """
+        return name.startswith((".", "__")) or self.config.is_page_file(name)
+
+    def is_ignored_dir(self, path: Path) -> bool:
+        return self.is_ignored(path.name) or path == self.source / self.config.assets_dir
+
+    def changes(self) -> Generator[set[Path] | None, None, None]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, config: Config, delay: float) -> None:
+        super().__init__(config, delay)
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self.watches: dict[int, Path] = {}
+        self.add_tree(self.source)
+        logger.info(f"Watch {len(self.watches)} directories with inotify")
+
+    def add_watch(self, path: Path) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), InotifyWatcher.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logger.warning(f"Can't watch {path}: {os.strerror(err)}")
+            return
+        self.watches[wd] = path
+
+    def add_tree(self, path: Path) -> None:
+        for work_dir, dirs, _ in FileUtil.walk(path):
+            self.add_watch(work_dir)
+            dirs[:] = [(p, st) for p, st in dirs if not self.is_ignored_dir(p)]
+
+    def read_events(self, changed: set[Path]) -> bool:
+        """ Read available events to the set of changed directories, returns False on the queue overflow """
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return True
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = InotifyWatcher.EVENT_HEADER.unpack_from(data, pos)
+            pos += InotifyWatcher.EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + name_len].rstrip(b"\0"))
+            pos += name_len
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                return False
+            work_dir = self.watches.get(wd)
+            if mask & InotifyWatcher.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if work_dir is None or (name and self.is_ignored(name)):
+                continue
+            if not name:
+                # the watched directory itself was deleted or moved
+                changed.add(work_dir.parent)
+                continue
+            changed.add(work_dir)
+            if mask & InotifyWatcher.IN_ISDIR and mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO) \
+                    and not self.is_ignored_dir(work_dir / name):
+                self.add_tree(work_dir / name)
+                changed.add(work_dir / name)
+        return True
+
+    def changes(self) -> Generator[set[Path] | None, None, None]:
+        while True:
+            changed: set[Path] = set()
+            select.select([self.fd], [], [])
+            complete = self.read_events(changed)
+            # debounce: wait until there are no new events during the delay
+            while select.select([self.fd], [], [], self.delay)[0]:
+                complete = self.read_events(changed) and complete
+            if not complete:
+                logger.warning("Inotify queue overflow, check all directories")
+                yield None
+            elif changed:
+                yield changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+    """ Detects changes by the modification times of the directories, it works everywhere,
+    but changes of the file content without changes in the directory entries are not detected.
+    """
+    def __init__(self, config: Config, delay: float) -> None:
+        super().__init__(config, delay)
+        self.state = self.get_state()
+        logger.info(f"Watch {len(self.state)} directories by polling every {self.delay}s")
+
+    def get_state(self) -> dict[Path, int]:
+        state: dict[Path, int] = {self.source: self.source.stat().st_mtime_ns}
+        for _, dirs, _ in FileUtil.walk(self.source):
+            dirs[:] = [(p, st) for p, st in dirs if not self.is_ignored_dir(p)]
+            state.update((p, st.st_mtime_ns) for p, st in dirs)
+        return state
+
+    def changes(self) -> Generator[set[Path] | None, None, None]:
+        while True:
+            time.sleep(self.delay)
+            state = self.get_state()
+            changed = {p for p, mtime in state.items() if self.state.get(p) != mtime}
+            changed.update(p.parent for p in self.state if p not in state)
+            self.state = state
+            if changed:
+                yield changed
+
+
+def create_watcher(config: Config, delay: float) -> Watcher:
+    try:
+        return InotifyWatcher(config, delay)
+    except (OSError, AttributeError) as ex:
+        logger.warning(f"Can't use inotify, use polling: {ex}")
+    return PollingWatcher(config, delay)
+
+
+def watch(config: Config, delay: float = 2.0) -> int:
+    """ Build the site and regenerate the changed directories until the process is interrupted """
+    config.incremental = True
+    # start watching before the build, to not miss changes during the build
+    watcher = create_watcher(config, delay)
+    process_dir(config.source, config=config)
+    builder = PageBuilder(config=config)
+    pipeline = BuildPipeline(config=config, builder=builder)
+    try:
+        for changed in watcher.changes():
+            if changed is None:
+                process_dir(config.source, config=config)
+                continue
+            logger.info(f"Changed directories: {len(changed)}")
+            files = update_dirs(changed, config, pipeline)
+            logger.info(f"Updated files: {len(files)}")
+    finally:
+        watcher.close()
+        pipeline.close()
+    return 0